@@ -5,12 +5,82 @@ import os
 import time
 import subprocess
 import sys
+import bisect
+import uuid
+import glob
+import math
+import heapq
+import argparse
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # Add these lines to import infofile
 current_script = os.path.dirname(os.path.realpath(__file__))
 directory_after = os.path.dirname(current_script)
 sys.path.append(directory_after)
 import infofile
+#the same file versions as the workers' ROOT file cache
+from fileversion import file_version
+
+#directory the reading containers write their outputs and timing files to
+PROCESS_DATA = os.path.join(directory_after, "process_data")
+
+#the learned task cost model lives outside process_data so it stays with the code, not the outputs
+COST_MODEL_FILE = os.path.join(directory_after, "cost_model.json")
+
+#sidecar index of every sample's tree layout, so the ROOT headers are only read again when a file changes
+TREE_INDEX_DIR = os.path.join(directory_after, "tree_index")
+
+#tasks are cut so that each one should take roughly this many seconds
+TARGET_TASK_SECONDS = 60
+
+#smallest range worth a task of its own, below this the per-task overhead dominates
+MIN_TASK_ENTRIES = 1000
+
+#weight of the newest run when a sample's seconds per entry is updated
+LEARNING_RATE = 0.5
+
+#cost assumed for samples while the model has not learned any sample at all
+DEFAULT_SECONDS_PER_ENTRY = 0.001
+
+#puts every task held by a worker whose heartbeat expired back on the queue, done in one
+#script so a worker that comes back at the same moment cannot also finish the task,
+#tasks left over from other runs are dropped instead of being requeued, and ranges whose
+#end was taken over by another worker are shortened to where that worker starts,
+#the range:* and running:* keys are found from the tasks and not passed in KEYS, see the README on Redis
+REQUEUE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+local moved = 0
+local task = redis.call('RPOP', KEYS[2])
+while task do
+    local work_item = cjson.decode(task)
+    if work_item['run_id'] == ARGV[3] then
+        local parts = work_item['parts'] or {work_item}
+        for _, part in ipairs(parts) do
+            local range_key = 'range:' .. ARGV[3] .. ':' .. part['sample'] .. ':' .. part['start']
+            local stolen_end = tonumber(redis.call('HGET', range_key, 'end'))
+            if stolen_end and stolen_end < part['end'] then
+                part['end'] = stolen_end
+            end
+            redis.call('SREM', 'running:' .. ARGV[3], range_key)
+            redis.call('DEL', range_key)
+        end
+        work_item['reaped'] = (work_item['reaped'] or 0) + 1
+        task = cjson.encode(work_item)
+        if ARGV[1] == 'priority' then
+            redis.call('ZADD', KEYS[4], work_item['cost'] or 0, task)
+        else
+            redis.call('RPUSH', KEYS[3], task)
+        end
+        moved = moved + 1
+    end
+    task = redis.call('RPOP', KEYS[2])
+end
+redis.call('SREM', KEYS[5], ARGV[2])
+return moved
+"""
 
 def run_command(command):
     process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -29,70 +99,658 @@ def prepare_environment():
     print("Creating Docker network 'AtlasNetwork'...")
     run_command("docker network create AtlasNetwork")
 
-    print("Removing existing files in 'process_data' directory...")
-    run_command("del /f /q .\\process_data\\*")
-
     print("Building Docker images without using cache...")
     run_command("docker-compose build --no-cache")
 
-def prepare_work_queue(r, samples, workers):
+#remote location of the 4lep ROOT files
+tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/"
+
+#upper bound on the number of remote files whose headers are opened at the same time
+MAX_OPEN_FILES = 6
+
+def sample_path(sample):
+    info_library = "Data/" if 'data' in sample else f"MC/mc_{infofile.infos[sample]['DSID']}."
+    return os.path.join(tuple_path, info_library + sample + ".4lep.root")
+
+#the branches read by every reading worker, used to work out the basket layout that matters
+READ_BRANCHES = ['lep_pt', 'lep_eta', 'lep_phi', 'lep_E', 'lep_charge', 'lep_type',
+                 'mcWeight', 'scaleFactor_PILEUP', 'scaleFactor_ELE', 'scaleFactor_MUON',
+                 'scaleFactor_LepTRIGGER']
+
+def fetch_tree_layout(sample):
+    #reads the number of entries together with the basket layout of the mini tree,
+    #all of which is held in the TTree metadata so no baskets are downloaded here
+    with uproot.open(sample_path(sample) + ":mini") as tree:
+        branches = [name for name in READ_BRANCHES if name in tree]
+        return {
+            "entries": tree.num_entries,
+            #entries at which every read branch starts a new basket
+            "boundaries": [int(x) for x in tree.common_entry_offsets(filter_name=branches)],
+            #per branch: the basket entry offsets and the compressed size of each basket
+            "baskets": {
+                name: ([int(x) for x in tree[name].entry_offsets],
+                       [int(tree[name].basket_compressed_bytes(i)) for i in range(tree[name].num_baskets)])
+                for name in branches
+            },
+            "branches": list(tree.keys()),
+        }
+
+def load_tree_layout(sample, r=None):
+    #the layout comes from the local sidecar index, then from Redis, and only if neither matches
+    #the file's current version are the headers read, the new index is then stored in both places
+    url = sample_path(sample)
+    version = file_version(url)
+    index_file = os.path.join(TREE_INDEX_DIR, hashlib.sha256(url.encode()).hexdigest()[:16] + ".json")
+    candidates = []
+    try:
+        with open(index_file) as f:
+            candidates.append(json.load(f))
+    except (OSError, ValueError):
+        pass
+    if r is not None and r.hexists("tree_index", url):
+        candidates.append(json.loads(r.hget("tree_index", url)))
+    for index in candidates:
+        if index.get("version") == version:
+            layout, source = index, "index"
+            break
+    else:
+        layout, source = fetch_tree_layout(sample), "headers"
+        layout.update(url=url, version=version)
+
+    os.makedirs(TREE_INDEX_DIR, exist_ok=True)
+    with open(index_file + ".tmp", "w") as f:
+        json.dump(layout, f)
+    os.replace(index_file + ".tmp", index_file)
+    #the workers look up the file version here instead of asking the server for it again
+    if r is not None:
+        r.hset("tree_index", url, json.dumps(layout))
+    layout["source"] = source
+    return layout
+
+def enumerate_samples(samples, max_open=MAX_OPEN_FILES, r=None):
+    #the header reads are fanned out over a bounded thread pool and each sample is
+    #yielded as soon as its entry count is known, so the slowest file no longer
+    #delays every other sample
+    with ThreadPoolExecutor(max_workers=max_open) as pool:
+        futures = {pool.submit(load_tree_layout, sample, r): sample for sample in samples}
+        for future in as_completed(futures):
+            sample = futures[future]
+            try:
+                yield sample, future.result(), None
+            except Exception as e:
+                yield sample, None, e
+
+def new_run_id():
+    #every run gets its own id so that its coverage ledger never mixes with earlier runs
+    return time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+
+def open_work_queue(r, run_id):
+    #workers keep waiting on an empty queue for as long as it is marked as building
+    #retries still waiting from an earlier run are dropped, its quarantine is kept for inspection
+    r.delete("work_queue", "work_pqueue", "retry_queue")
+    r.set("queue_status", "building")
+    r.set("current_run", run_id)
+    print(f"Cleared existing work queue for run {run_id}")
+
+def partition_entries(entries, n_tasks):
+    #splits [0, entries) into n_tasks contiguous ranges whose sizes differ by at most one entry,
+    #the remainder is spread over the ranges instead of being dropped
+    n_tasks = max(1, min(n_tasks, entries))
+    return [(i * entries) // n_tasks for i in range(n_tasks + 1)]
+
+def check_coverage(cuts, entries):
+    #every entry has to belong to exactly one task
+    if cuts[0] != 0 or cuts[-1] != entries:
+        raise ValueError(f"Task ranges cover [{cuts[0]}, {cuts[-1]}) instead of [0, {entries})")
+    if any(b <= a for a, b in zip(cuts[:-1], cuts[1:])):
+        raise ValueError(f"Task ranges are empty or overlapping: {cuts}")
+
+def align_cuts(cuts, boundaries):
+    #moves every interior cut onto the nearest entry where all branches start a new basket,
+    #cuts that collapse onto the same boundary are merged so no empty ranges are created
+    aligned = [cuts[0]]
+    for cut in cuts[1:-1]:
+        i = bisect.bisect_left(boundaries, cut)
+        candidates = boundaries[max(i - 1, 0):i + 1]
+        snapped = min(candidates, key=lambda b: abs(b - cut)) if candidates else cut
+        if aligned[-1] < snapped < cuts[-1]:
+            aligned.append(snapped)
+    aligned.append(cuts[-1])
+    return aligned
+
+def duplicated_bytes(cuts, baskets):
+    #a cut that falls inside a basket makes both neighbouring tasks download and
+    #decompress that basket, so its compressed size is counted once per such cut
+    total = 0
+    for offsets, sizes in baskets.values():
+        for cut in cuts[1:-1]:
+            i = bisect.bisect_right(offsets, cut) - 1
+            if 0 <= i < len(sizes) and offsets[i] < cut:
+                total += sizes[i]
+    return total
+
+def load_cost_model(path=COST_MODEL_FILE):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"samples": {}, "learned_runs": [], "max_task_entries": {}}
+
+def save_cost_model(model, path=COST_MODEL_FILE):
+    with open(path + ".tmp", "w") as f:
+        json.dump(model, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def update_cost_model(model, timing_dir=PROCESS_DATA):
+    #the timing files the workers wrote are summed per run and sample, runs that were
+    #already learned from are skipped so re-reading the same files does not bias the model
+    observed = {}
+    for timing_file in glob.glob(os.path.join(timing_dir, "new_time_plot_worker*.json")):
+        try:
+            with open(timing_file) as f:
+                timing = json.load(f)
+        except (OSError, ValueError):
+            continue
+        run_id = timing.get("run_id")
+        entries = timing["worker_end"] - timing["worker_beginning"]
+        if not run_id or run_id in model["learned_runs"] or entries <= 0:
+            continue
+        totals = observed.setdefault((run_id, timing["sample"]), [0.0, 0])
+        totals[0] += timing["time"]
+        totals[1] += entries
+
+    for (run_id, sample), (seconds, entries) in sorted(observed.items()):
+        rate = seconds / entries
+        known = model["samples"].get(sample)
+        if known:
+            known["seconds_per_entry"] = (1 - LEARNING_RATE) * known["seconds_per_entry"] + LEARNING_RATE * rate
+            known["runs"] += 1
+        else:
+            model["samples"][sample] = {"seconds_per_entry": rate, "runs": 1}
+    #only the most recent run ids are remembered, older timing files are overwritten anyway
+    model["learned_runs"] = (model["learned_runs"] + sorted({run_id for run_id, _ in observed}))[-100:]
+    return len(observed)
+
+def estimate_seconds(model, sample, entries):
+    known = model["samples"].get(sample)
+    return known["seconds_per_entry"] * entries if known else None
+
+def task_cost(model, sample, entries):
+    #samples the model has not seen are costed at the average rate of the samples it knows
+    seconds = estimate_seconds(model, sample, entries)
+    if seconds is None:
+        rates = [known["seconds_per_entry"] for known in model["samples"].values()]
+        seconds = entries * (sum(rates) / len(rates) if rates else DEFAULT_SECONDS_PER_ENTRY)
+    return seconds
+
+def predict_makespan(costs, workers):
+    #simulating longest-processing-time-first: each task, largest first, goes to the worker that frees up first
+    finish_times = [0.0] * max(workers, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(finish_times, finish_times[0] + cost)
+    return max(finish_times)
+
+def max_task_entries(model, sample):
+    #the largest task a sample can have without running out of memory, learned from the tasks workers split
+    return model.get("max_task_entries", {}).get(sample)
+
+def update_task_caps(model, split_sizes):
+    #a cap only ever comes down, a sample that needed smaller tasks once is likely to need them again
+    caps = model.setdefault("max_task_entries", {})
+    for sample, entries in split_sizes.items():
+        caps[sample] = min(caps.get(sample, entries), entries)
+
+def plan_task_count(model, sample, entries, workers, target=TARGET_TASK_SECONDS):
+    #samples the model has not seen yet are split evenly over the workers
+    seconds = estimate_seconds(model, sample, entries)
+    if seconds is None:
+        n_tasks = workers
+    else:
+        n_tasks = max(1, min(math.ceil(seconds / target), entries // MIN_TASK_ENTRIES))
+    cap = max_task_entries(model, sample)
+    if cap:
+        n_tasks = max(n_tasks, math.ceil(entries / cap))
+    return n_tasks
+
+def push_tasks(r, work_items, priority=False):
+    #all tasks are sent to Redis in a single pipelined round trip, in priority mode they go
+    #into a sorted set scored by their estimated cost so the workers pop the most expensive first
+    pipe = r.pipeline()
+    for work_item in work_items:
+        if priority:
+            pipe.zadd("work_pqueue", {json.dumps(work_item): work_item["cost"]})
+        else:
+            pipe.lpush("work_queue", json.dumps(work_item))
+        print(f"Created task: {work_item}")
+    pipe.execute()
+    return len(work_items)
+
+def merged_task(run_id, parts, cost):
+    return {
+        "run_id": run_id,
+        "task_id": "merged:" + "+".join(part["sample"] for part in parts),
+        "parts": parts,
+        "cost": cost
+    }
+
+#marks a running range as speculated and closes it to stealing, so its end is fixed from now on
+SPECULATE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('HSETNX', KEYS[1], 'speculated', 1) == 0 then
+    return false
+end
+redis.call('HSET', KEYS[1], 'nosteal', 1)
+return redis.call('HMGET', KEYS[1], 'sample', 'task_id', 'start', 'end', 'worker_id', 'started')
+"""
+
+#a sample needs this many finished ranges before its slow ranges are duplicated
+SPECULATION_MIN_RANGES = 3
+
+def queued_tasks(r):
+    return r.llen("work_queue") + r.zcard("work_pqueue")
+
+def in_flight_tasks(r):
+    #tasks a worker has claimed but not finished sit in that worker's processing list
+    return sum(r.llen(f"processing:{worker}") for worker in r.smembers("workers"))
+
+def requeue_stalled_tasks(r, run_id):
+    moved = 0
+    for worker in r.smembers("workers"):
+        moved += r.eval(REQUEUE_SCRIPT, 5, f"heartbeat:{worker}", f"processing:{worker}",
+                        "work_queue", "work_pqueue", "workers",
+                        r.get("queue_mode") or "fifo", worker, run_id)
+    if moved:
+        print(f"Requeued {moved} tasks from workers that stopped sending heartbeats")
+    return moved
+
+def p90(values):
+    values = sorted(values)
+    return values[math.ceil(0.9 * len(values)) - 1]
+
+def speculate_stragglers(r, run_id, durations):
+    #only once nothing is waiting in the queue, ranges running longer than the p90 duration
+    #of their sample get a duplicate that any idle worker can pick up
+    if queued_tasks(r):
+        return 0
+    launched = 0
+    for range_key in r.smembers(f"running:{run_id}"):
+        sample, started, speculated = r.hmget(range_key, "sample", "started", "speculated")
+        if speculated or not started or len(durations.get(sample, [])) < SPECULATION_MIN_RANGES:
+            continue
+        if time.time() - float(started) < p90(durations[sample]):
+            continue
+        fields = r.eval(SPECULATE_SCRIPT, 1, range_key)
+        if not fields:
+            continue
+        sample, task_id, start, end, _, _ = fields
+        #the duplicate gets a worker id of its own, as stolen tasks do, so the two copies never
+        #overwrite each other's timing file
+        duplicate = {"run_id": run_id, "task_id": f"{task_id}~spec:{start}", "sample": sample,
+                     "start": int(start), "end": int(end), "cost": 0, "speculative": True,
+                     "worker_id": 1000 + r.hincrby(f"stolen_ids:{run_id}", sample)}
+        pipe = r.pipeline()
+        #the duplicate counts as a task of its own and goes to the front of the queue
+        pipe.xadd(f"events:{run_id}", {"type": "task_added", "task_id": duplicate["task_id"]})
+        if r.get("queue_mode") == "priority":
+            pipe.zadd("work_pqueue", {json.dumps(duplicate): float("inf")})
+        else:
+            pipe.rpush("work_queue", json.dumps(duplicate))
+        pipe.execute()
+        print(f"Launched a speculative copy of {sample} from {start} to {end}")
+        launched += 1
+    return launched
+
+#the tasks of a run that used up their retries, with the tracebacks of every attempt
+def quarantined_tasks(r, run_id):
+    return [task for task in map(json.loads, r.lrange("quarantine", 0, -1)) if task.get("run_id") == run_id]
+
+def plan_tasks(samples, workers, run_id, max_open=MAX_OPEN_FILES, model=None, target=TARGET_TASK_SECONDS, r=None):
+    #yields (sample, entries, work_items) as soon as each sample's header has been read,
+    #tasks of merged samples come with the sample that filled them up, or at the end with sample None,
+    #a sample whose header could not be read comes with entries None and no tasks
+    if model is None:
+        model = load_cost_model()
+    bytes_avoided = 0
+    #samples that are cheaper than half a task are collected here and queued together as one task
+    merged_parts, merged_seconds = [], 0.0
+    enumeration_start = time.time()
+    
+    for sample, layout, error in enumerate_samples(samples, max_open, r):
+        if error is not None:
+            print(f"Error creating tasks for {sample}: {error}")
+            yield sample, None, []
+            continue
+
+        entries = layout["entries"]
+
+        print(f"Creating tasks for sample: {sample} ({entries} entries from the {layout['source']}, "
+              f"known after {time.time() - enumeration_start:.1f}s)")
+
+        if entries == 0:
+            print(f"Skipping {sample}: the tree has no entries")
+            yield sample, entries, []
+            continue
+
+        seconds = estimate_seconds(model, sample, entries)
+        cap = max_task_entries(model, sample)
+        if seconds is not None and seconds < target / 2 and (not cap or entries <= cap):
+            print(f"Merging {sample} into a shared task (estimated {seconds:.1f}s)")
+            merged_parts.append({"sample": sample, "start": 0, "end": entries, "worker_id": 1})
+            merged_seconds += seconds
+            if merged_seconds >= target:
+                yield sample, entries, [merged_task(run_id, merged_parts, merged_seconds)]
+                merged_parts, merged_seconds = [], 0.0
+            else:
+                yield sample, entries, []
+            continue
+
+        n_tasks = plan_task_count(model, sample, entries, workers, target)
+        naive_cuts = partition_entries(entries, n_tasks)
+        cuts = align_cuts(naive_cuts, layout["boundaries"])
+        check_coverage(cuts, entries)
+        avoided = duplicated_bytes(naive_cuts, layout["baskets"]) - duplicated_bytes(cuts, layout["baskets"])
+        bytes_avoided += avoided
+        print(f"Aligned {sample} to basket boundaries, avoiding {avoided / 1e6:.2f} MB of duplicated compressed reads")
+        
+        work_items = [{
+            "run_id": run_id,
+            "task_id": f"{sample}:{start}-{end}",
+            "sample": sample,
+            "start": start,
+            "end": end,
+            "worker_id": i + 1,
+            "cost": task_cost(model, sample, end - start)
+        } for i, (start, end) in enumerate(zip(cuts[:-1], cuts[1:]))]
+        if seconds is not None:
+            print(f"Split {sample} into {len(work_items)} tasks of about {seconds / len(work_items):.1f}s")
+        yield sample, entries, work_items
+
+    if merged_parts:
+        yield None, 0, [merged_task(run_id, merged_parts, merged_seconds)]
+
+    print(f"Duplicated compressed bytes avoided by basket alignment: {bytes_avoided / 1e6:.2f} MB")
+    print(f"Sample enumeration took {time.time() - enumeration_start:.1f}s")
+
+def prepare_work_queue(r, samples, workers, run_id, max_open=MAX_OPEN_FILES, model=None,
+                       target=TARGET_TASK_SECONDS, priority=False):
     # Clear existing queue
-    r.delete("work_queue")
-    print("Cleared existing work queue")
+    open_work_queue(r, run_id)
+    r.set("queue_mode", "priority" if priority else "fifo")
+    #the coverage ledger records how many entries each sample has, workers add the ranges they finish
+    #samples that could not be planned are kept apart, the run is never complete without them
+    r.delete(f"ledger:{run_id}:expected", f"ledger:{run_id}:done", f"ledger:{run_id}:unplanned")
     
-    tuple_path = "https://atlas-opendata.web.cern.ch/atlas-opendata/samples/2020/4lep/"
     tasks_created = 0
+    task_costs = []
+    for sample, entries, work_items in plan_tasks(samples, workers, run_id, max_open, model, target, r):
+        if entries is None:
+            r.sadd(f"ledger:{run_id}:unplanned", sample)
+        elif sample is not None:
+            r.hset(f"ledger:{run_id}:expected", sample, entries)
+        if work_items:
+            tasks_created += push_tasks(r, work_items, priority)
+            task_costs += [work_item["cost"] for work_item in work_items]
     
-    for sample in samples:
-        print(f"Creating tasks for sample: {sample}")
-        info_library = "Data/" if 'data' in sample else f"MC/mc_{infofile.infos[sample]['DSID']}."
-        path = os.path.join(tuple_path, info_library + sample + ".4lep.root")
-        
+    r.set("queue_status", "complete")
+    print(f"Total tasks created: {tasks_created}")
+    return tasks_created, task_costs
+
+def run_local(samples, workers, model=None):
+    #runs the same reading tasks in a local process pool, without Docker or Redis, writing
+    #the outputs and timing files to process_data in the layout the containers use
+    os.makedirs(PROCESS_DATA, exist_ok=True)
+    os.environ["PROCESS_INFO"] = PROCESS_DATA
+    sys.path.append(os.path.join(directory_after, "Reading"))
+    import reading
+
+    run_id = new_run_id()
+    run_start = time.time()
+    expected, unplanned, finished, task_costs, cutflow = {}, [], {}, [], {}
+    print(f"Running {run_id} locally with {workers} processes...")
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        #tasks are submitted as soon as each sample is planned, like the streaming mode
+        futures = {}
+        for sample, entries, work_items in plan_tasks(samples, workers, run_id, model=model):
+            if entries is None:
+                unplanned.append(sample)
+            elif sample is not None:
+                expected[sample] = entries
+            for work_item in work_items:
+                futures[pool.submit(reading.run_task, work_item)] = work_item
+                task_costs.append(work_item["cost"])
+
+        for completed, future in enumerate(as_completed(futures), 1):
+            work_item = futures[future]
+            try:
+                for sample, start, end, stats in future.result():
+                    finished.setdefault(sample, []).append((start, end))
+                    if stats is not None:
+                        add_cutflow(cutflow, stats["cutflow"])
+                print(f"Completed task {work_item['task_id']} ({completed}/{len(futures)})")
+            except Exception as e:
+                print(f"Error processing task {work_item['task_id']}: {e}")
+
+    #every sample has to be covered exactly once, as the Redis ledger checks for container runs
+    for sample, entries in expected.items():
+        covered = 0
+        for start, end in sorted(finished.get(sample, [])):
+            if start != covered:
+                break
+            covered = end
+        if covered != entries:
+            print(f"Warning: {sample} was not read exactly once, ranges read: {sorted(finished.get(sample, []))}")
+    for sample in unplanned:
+        print(f"Warning: {sample} was not read, its header could not be read to plan its tasks")
+
+    if cutflow:
+        print_cutflow(cutflow)
+    print(f"Predicted makespan: {predict_makespan(task_costs, workers):.1f} seconds, "
+          f"achieved makespan: {time.time() - run_start:.1f} seconds")
+
+    print("Plotting...")
+    #plotting aggregates the outputs listed in this run's manifest
+    os.environ["RUN_ID"] = run_id
+    subprocess.run([sys.executable, os.path.join(directory_after, "Plotting", "plotting.py")], env=os.environ)
+
+#adding the events left after each cut of one range to the run's totals
+def add_cutflow(totals, cutflow):
+    for name, count in cutflow.items():
+        totals[name] = totals.get(name, 0) + int(count)
+
+#the events read and those left after each cut, with the fraction of the events read
+def print_cutflow(cutflow):
+    print("Cutflow:")
+    for name, count in cutflow.items():
+        print(f"\t{name}: {count} events ({100 * count / max(cutflow.get('all', 0), 1):.1f}%)")
+
+def monitor_run(r, run_id, total_tasks, run_start, predicted_makespan, report_every=5, model=None):
+    #follows the run's event stream, the workers add one event per finished range and per finished task
+    print("Processing data...")
+    stream = f"events:{run_id}"
+    last_id = "0-0"
+    expected = {sample: int(entries) for sample, entries in r.hgetall(f"ledger:{run_id}:expected").items()}
+    entries_done = {sample: 0 for sample in expected}
+    done_tasks, failed_tasks = set(), set()
+    #wall times of finished ranges per sample, used to spot stragglers
+    durations = {}
+    #largest piece per sample of the tasks workers had to split, kept in the cost model for the next run
+    split_sizes = {}
+    events_in = bytes_read = retries = 0
+    #ranges read from the workers' ROOT file cache, out of all ranges that went through it
+    cache_hits = cache_reads = 0
+    #HTTP requests sent by the workers' pooled sources and the new connections they needed
+    http_requests = http_handshakes = 0
+    #events left after each cut of the selection, over all samples
+    cutflow = {}
+    last_report = last_event = time.time()
+
+    while True:
+        requeue_stalled_tasks(r, run_id)
+        for _, messages in r.xread({stream: last_id}, count=500, block=report_every * 1000) or []:
+            for last_id, event in messages:
+                last_event = time.time()
+                if event["type"] == "range":
+                    entries_done[event["sample"]] = entries_done.get(event["sample"], 0) + int(event["end"]) - int(event["start"])
+                    events_in += int(event["events_in"])
+                    bytes_read += int(event["bytes_read"])
+                    durations.setdefault(event["sample"], []).append(float(event["wall_time"]))
+                    http_requests += int(event.get("http_requests", 0))
+                    http_handshakes += int(event.get("http_handshakes", 0))
+                    add_cutflow(cutflow, json.loads(event.get("cutflow", "{}")))
+                    if event.get("cache", "off") != "off":
+                        cache_reads += 1
+                        cache_hits += event["cache"] == "hit"
+                elif event["type"] == "task_done":
+                    done_tasks.add(event["task_id"])
+                elif event["type"] == "task_failed":
+                    failed_tasks.add(event["task_id"])
+                elif event["type"] == "task_split":
+                    #the task is replaced by its pieces, each of which reports back on its own
+                    done_tasks.add(event["task_id"])
+                    total_tasks += int(event["pieces"])
+                    for sample, entries in json.loads(event["sizes"]).items():
+                        split_sizes[sample] = min(split_sizes.get(sample, entries), entries)
+                    print(f"Task {event['task_id']} was split into {event['pieces']} pieces: {event['reason']}")
+                elif event["type"] == "task_retry":
+                    #the task is back in the queue after its backoff, so it still counts as unfinished
+                    retries += 1
+                    print(f"Task {event['task_id']} failed on attempt {event['attempt']} and will be retried: {event['error']}")
+                elif event["type"] == "task_added":
+                    #an idle worker took over the end of a running range as a task of its own
+                    total_tasks += 1
+
+        speculate_stragglers(r, run_id, durations)
+
+        #a run is complete when every task has reported back, not when the queue is empty
+        finished_tasks = len(done_tasks | failed_tasks)
+        if finished_tasks >= total_tasks:
+            #lets the waiting workers know they can stop
+            r.set("queue_status", "finished")
+            incomplete = {sample: entries - entries_done.get(sample, 0) for sample, entries in expected.items()
+                          if entries_done.get(sample, 0) < entries}
+            unplanned = sorted(r.smembers(f"ledger:{run_id}:unplanned"))
+            if failed_tasks - done_tasks or incomplete or unplanned:
+                print(f"Run {run_id} is INCOMPLETE: {len(failed_tasks - done_tasks)} tasks quarantined")
+                for task in quarantined_tasks(r, run_id):
+                    #the last line of the last traceback is usually enough to tell what went wrong
+                    print(f"\t{task['task_id']} after {task['attempts']} attempts: "
+                          f"{task['errors'][-1].strip().splitlines()[-1]}")
+                for sample, missing in incomplete.items():
+                    print(f"\t{sample}: {missing} entries were not read")
+                for sample in unplanned:
+                    print(f"\t{sample}: not read, its header could not be read to plan its tasks")
+                print("The full tracebacks are kept in the Redis list 'quarantine'")
+            else:
+                print("All tasks completed!")
+            if cutflow:
+                print_cutflow(cutflow)
+            if retries:
+                print(f"{retries} failed attempts were retried")
+            if split_sizes and model is not None:
+                update_task_caps(model, split_sizes)
+                save_cost_model(model)
+                print(f"Capped the task size of {', '.join(sorted(split_sizes))} for the next run")
+            print(f"Predicted makespan: {predicted_makespan:.1f} seconds, "
+                  f"achieved makespan: {time.time() - run_start:.1f} seconds")
+            return not (failed_tasks - done_tasks or incomplete or unplanned)
+
+        if time.time() - last_event > 60:
+            print("Warning: No progress detected for 1 minute. Checking worker status...")
+            subprocess.run("docker ps", shell=True)
+            last_event = time.time()
+
+        if time.time() - last_report >= report_every:
+            last_report = time.time()
+            elapsed_time = time.time() - run_start
+            total_entries = sum(expected.values())
+            total_done = sum(entries_done.values())
+            #the ETA assumes the entries still to read go at the average rate seen so far
+            eta = (total_entries - total_done) * elapsed_time / total_done if total_done else float("nan")
+            print(f"Progress: {finished_tasks}/{total_tasks} tasks completed "
+                  f"({queued_tasks(r)} queued, {in_flight_tasks(r)} running)")
+            print(f"Elapsed time: {elapsed_time:.1f} seconds, ETA: {eta:.1f} seconds")
+            print(f"Throughput: {events_in / elapsed_time:.0f} events/s, {bytes_read / 1e6 / elapsed_time:.2f} MB/s")
+            if cache_reads:
+                print(f"ROOT file cache: {cache_hits}/{cache_reads} ranges read from a cached file")
+            if http_requests:
+                print(f"HTTP: {http_requests} range requests over {http_handshakes} new connections")
+            for sample, entries in expected.items():
+                if entries:
+                    print(f"\t{sample}: {100 * entries_done.get(sample, 0) / entries:.1f}%")
+            print("-" * 50)
+
+def wait_for_redis(r, timeout=30):
+    #a Redis that is already running answers straight away, a fresh container takes a few seconds
+    deadline = time.time() + timeout
+    while True:
         try:
-            with uproot.open(path + ":mini") as tree:
-                entries = tree.num_entries
-                
-                #Specific handling for the ggH125_ZZ4lep sample
-                if sample == 'ggH125_ZZ4lep' and workers > 2:
-                    extra_workers = calculate_extra_workers(workers)
-                    batch_size = entries // (workers + extra_workers)
-                else:
-                    batch_size = entries // workers
-                
-                remainder = entries % workers
-                
-                for i in range(workers):
-                    start = i * batch_size
-                    end = start + batch_size
-                    
-                    
-                    
-                    work_item = {
-                        "sample": sample,
-                        "start": start,
-                        "end": end,
-                        "worker_id": i + 1
-                    }
-                    
-                    # Push to Redis queue and verify
-                    r.lpush("work_queue", json.dumps(work_item))
-                    tasks_created += 1
-                    print(f"Created task {tasks_created}: {work_item}")
-                    
-        except Exception as e:
-            print(f"Error creating tasks for {sample}: {e}")
-    
-    total_tasks = r.llen("work_queue")
-    print(f"Total tasks in queue: {total_tasks}")
-    return total_tasks
+            return r.ping()
+        except redis.exceptions.ConnectionError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+def live_workers(r):
+    #registered workers whose heartbeat has not expired, daemon workers stay registered between runs
+    workers = list(r.smembers("workers"))
+    if not workers:
+        return 0
+    return r.exists(*[f"heartbeat:{worker}" for worker in workers])
 
-def calculate_extra_workers(workers):
-    if workers <= 7:
-        return (workers - 1) // 2
+def start_containers(r, workers, daemon=False):
+    if daemon:
+        #warm daemon workers pick up the new run's tasks as soon as they are queued,
+        #only the plotting container has to be started again
+        r.delete("worker_shutdown")
+        warm = live_workers(r)
+        if warm >= workers:
+            print(f"Using {warm} warm daemon workers")
+            subprocess.run("docker-compose up -d --no-deps plotting", shell=True)
+            return
+        os.environ["WORKER_DAEMON"] = "1"
+    print("Starting worker containers...")
+    subprocess.run("docker-compose up -d", shell=True)
+
+def shutdown_workers(r, timeout=60):
+    #daemon workers stop after the task they are on, waiting here until they have all left
+    r.set("worker_shutdown", 1)
+    deadline = time.time() + timeout
+    while live_workers(r) and time.time() < deadline:
+        time.sleep(1)
+    if live_workers(r):
+        print(f"{live_workers(r)} workers are still running after {timeout} seconds")
     else:
-        return workers - 4
+        print("All daemon workers have shut down")
+
+# Define samples
+samples = ['data_A', 'data_B', 'data_C', 'data_D', 'Zee', 'Zmumu', 
+           'ttbar_lep', 'llll', 'ggH125_ZZ4lep', 'VBFH125_ZZ4lep', 
+           'WH125_ZZ4lep', 'ZH125_ZZ4lep']
 
 def main():
+    parser = argparse.ArgumentParser(description="Distributes the ATLAS 4-lepton analysis over reading workers")
+    parser.add_argument("--local", type=int, metavar="N",
+                        help="run on this machine with N processes, without Docker or Redis")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep the reading workers running after the run for the next one")
+    parser.add_argument("--shutdown", action="store_true",
+                        help="stop the daemon reading workers and exit")
+    args = parser.parse_args()
+
+    if args.shutdown:
+        r = redis.Redis(host='localhost', port=6379, decode_responses=True)
+        shutdown_workers(r)
+        return
+
+    #the timings of earlier runs are learned before the next run starts, runs already learned are skipped
+    model = load_cost_model()
+    if update_cost_model(model):
+        save_cost_model(model)
+        print(f"Updated the task cost model with timings from {PROCESS_DATA}")
+
+    if args.local:
+        run_local(samples, args.local, model)
+        return
+
     try:
         workers = int(input("Enter the number of workers to use: "))
     except ValueError:
@@ -102,63 +760,47 @@ def main():
     if input("Do you want to prepare the environment? (y/n): ").strip().lower() == 'y':
         prepare_environment()
 
+    #in streaming mode the reading containers are started before the work queue is built
+    streaming = input("Start workers while the work queue is being built? (y/n): ").strip().lower() == 'y'
+
+    #in priority mode the tasks with the largest estimated cost are started first
+    priority = input("Schedule the most expensive tasks first? (y/n): ").strip().lower() == 'y'
+
     # Set environment variable for docker-compose
     os.environ['NUM_WORKERS'] = str(workers)
 
     # Start Redis first
     print("Starting Redis...")
     subprocess.run("docker-compose up -d redis", shell=True)
-    time.sleep(5)  # Wait for Redis to be ready
 
     # Connect to Redis and prepare work queue
     print("Connecting to Redis and preparing work queue...")
     r = redis.Redis(host='localhost', port=6379, decode_responses=True)
+    wait_for_redis(r)  # Wait for Redis to be ready
+    run_id = new_run_id()
     
-    # Define samples
-    samples = ['data_A', 'data_B', 'data_C', 'data_D', 'Zee', 'Zmumu', 
-               'ttbar_lep', 'llll', 'ggH125_ZZ4lep', 'VBFH125_ZZ4lep', 
-               'WH125_ZZ4lep', 'ZH125_ZZ4lep']
-    
-    # Prepare work queue
-    total_tasks = prepare_work_queue(r, samples, workers)
-    print(f"Created {total_tasks} tasks in Redis queue")
+    if streaming:
+        #the queue is marked as building first so that the workers wait for tasks instead of exiting
+        open_work_queue(r, run_id)
+        r.set("queue_mode", "priority" if priority else "fifo")
+        run_start = time.time()
+        start_containers(r, workers, args.daemon)
+        total_tasks, task_costs = prepare_work_queue(r, samples, workers, run_id, model=model, priority=priority)
+        print(f"Created {total_tasks} tasks in Redis queue")
+    else:
+        # Prepare work queue
+        total_tasks, task_costs = prepare_work_queue(r, samples, workers, run_id, model=model, priority=priority)
+        print(f"Created {total_tasks} tasks in Redis queue")
 
-    # Start the remaining containers
-    print("Starting worker containers...")
-    subprocess.run("docker-compose up -d", shell=True)
+        # Start the remaining containers
+        run_start = time.time()
+        start_containers(r, workers, args.daemon)
 
-    # Monitor progress
-    print("Processing data...")
-    start_time = time.time()
-    last_count = -1
-    no_progress_count = 0
-    
-    while True:
-        remaining_tasks = r.llen("work_queue")
-        completed_tasks = total_tasks - remaining_tasks
-        
-        if remaining_tasks == last_count:
-            no_progress_count += 1
-            if no_progress_count > 12:
-                print("Warning: No progress detected for 1 minute. Checking worker status...")
-                subprocess.run("docker ps", shell=True)
-                no_progress_count = 0
-        else:
-            no_progress_count = 0
-        
-        last_count = remaining_tasks
-        
-        if remaining_tasks == 0:
-            print("All tasks completed!")
-            break
-        
-        elapsed_time = time.time() - start_time
-        print(f"Progress: {completed_tasks}/{total_tasks} tasks completed")
-        print(f"Elapsed time: {elapsed_time:.1f} seconds")
-        print(f"Remaining tasks: {remaining_tasks}")
-        print("-" * 50)
-        
-        time.sleep(5)
+    predicted_makespan = predict_makespan(task_costs, workers)
+    print(f"Predicted makespan: {predicted_makespan:.1f} seconds")
+
+    if not monitor_run(r, run_id, total_tasks, run_start, predicted_makespan, model=model):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,12 +1,16 @@
 import numpy as np
 import os
 import glob
-import awkward as ak
 import time
 import json
+import sys
+import redis
 import matplotlib.pyplot as plt
 from matplotlib.ticker import AutoMinorLocator
 
+#directory the workers wrote to and the plots are saved in, the bind volume inside the containers
+PROCESS_INFO = os.environ.get("PROCESS_INFO", "/mydir/process_info")
+
 #defining the variables from reading.py that are needed in plotting as well:
 MeV = 0.001
 GeV = 1.0
@@ -38,60 +42,121 @@ samples = {
 
 }
 
-#data aggregation function for all the workers batches
-#taken from the binded volume they were written in
-def data_aggregation(binded_volume="/mydir/process_info/"):
-    #defining a list of all the sample names to be processed
-    all_samples = ['data_A', 'data_B', 'data_C', 'data_D', 'Zee', 'Zmumu', 'ttbar_lep', 'llll', 'ggH125_ZZ4lep', 'VBFH125_ZZ4lep', 'WH125_ZZ4lep', 'ZH125_ZZ4lep']
-
-    #initialising a dictionary to hold the processed data for each sample
-    
-    sample_dict = {sample: [] for sample in all_samples}
-    #each sample key in the dictionary has an associated list to store the data
-
-    #iterating through files in the specified directory
-   
-    for id_file in os.listdir(binded_volume):
-         #looks for files that are relevant to the analysis since they start with reading_ and are awkwd files
-        if id_file.startswith("reading_"):
-            #extracting the sample name from the file name
-            id_sample = id_file.split("-", 1)[0].replace("reading_", "")
-            #if the sample is in the sample dictionary it reads and appends its data
-            if id_sample in sample_dict:
-                #reading the parquet 
-                data_captured = ak.from_parquet(os.path.join(binded_volume, id_file))
-                #appending the data
-                sample_dict[id_sample].append(data_captured)
-
-    #defining a mapping of categories to their corresponding samples
-    category_map = {
-        'data': ['data_A', 'data_B', 'data_C', 'data_D'],
-        'Background $Z,t\\bar{t}$': ['Zee', 'Zmumu', 'ttbar_lep'],
-        'Background $ZZ^*$': ['llll'],
-        'Signal ($m_H$ = 125 GeV)': ['ggH125_ZZ4lep', 'VBFH125_ZZ4lep', 'WH125_ZZ4lep', 'ZH125_ZZ4lep']
-    }
-
-    #used for categorising the data into different physics backgrounds and signal
-
-    #initialise a dictionary to hold aggregated data for each category
-    dictionary_agg = {category: [] for category in category_map}
-
-    #aggregating the data for each category
-    for category, samples in category_map.items():
-        #concatenating all the data arrays for each sample within a category
-        for sample in samples:
-            if sample_dict[sample]:
-                #appending based on the sample location in the category
-                dictionary_agg[category].append(ak.concatenate(sample_dict[sample]))
-
-    #concatenating arrays within each category
-    for x in dictionary_agg:
-        #if there are multiple data arrays for a category, they are combined into a single array
-        dictionary_agg[x] = ak.concatenate(dictionary_agg[x]) if dictionary_agg[x] else []
-    #returning the aggregated data dictionary to use for plotting below:
-    return dictionary_agg
-
-def plot_processing_time(binded_volume="/mydir/process_info/"):
+#waiting until the manager marks the current run as finished, every task has then reported back,
+#the manager sets the status to building before the containers start so an earlier run is never taken
+def wait_for_run(host='redis', port=6379):
+    try:
+        r = redis.Redis(host=host, port=port, decode_responses=True)
+        while r.get("queue_status") != "finished":
+            print(f"Waiting for run {r.get('current_run')} to finish...")
+            time.sleep(5)
+    except redis.exceptions.ConnectionError:
+        #local runs have no Redis, the manager only starts plotting once the run is done
+        pass
+
+#checking the coverage ledger of a run: every entry of every sample must have been read exactly once
+def coverage_problems(r, run_id):
+    problems = []
+    expected = r.hgetall(f"ledger:{run_id}:expected")
+    done = {}
+    for record in r.lrange(f"ledger:{run_id}:done", 0, -1):
+        record = json.loads(record)
+        done.setdefault(record["sample"], []).append((record["start"], record["end"]))
+
+    for sample, entries in expected.items():
+        #walking the finished ranges in order, anything between them is a gap and anything read twice an overlap
+        position = 0
+        for start, end in sorted(done.get(sample, [])):
+            if start > position:
+                problems.append(f"{sample}: entries {position}-{start} were not read")
+            elif start < position:
+                problems.append(f"{sample}: entries {start}-{min(end, position)} were read more than once")
+            position = max(position, end)
+        if position < int(entries):
+            problems.append(f"{sample}: entries {position}-{entries} were not read")
+
+    for sample in done:
+        if sample not in expected:
+            problems.append(f"{sample}: ranges were read for a sample that is not part of the run")
+    for sample in sorted(r.smembers(f"ledger:{run_id}:unplanned")):
+        problems.append(f"{sample}: not read, the manager could not read its header to plan its tasks")
+    return problems
+
+#checking the ledger of the current run once, wait_for_run has already seen every task report back
+#so the ledger is final and any gap left in it stays
+def check_coverage(host='redis', port=6379):
+    try:
+        r = redis.Redis(host=host, port=port, decode_responses=True)
+        run_id = r.get("current_run")
+    except Exception as e:
+        print(f"Warning: coverage ledger unavailable ({e}), aggregating without a coverage check")
+        return []
+    if not run_id:
+        print("Warning: no run found in the coverage ledger, aggregating without a coverage check")
+        return []
+
+    return coverage_problems(r, run_id)
+
+#finding the run to plot: given by the manager for local runs, the current run in Redis for
+#container runs, or else the run whose manifest was written last
+def current_run_id(binded_volume=PROCESS_INFO, host='redis', port=6379):
+    if os.environ.get("RUN_ID"):
+        return os.environ["RUN_ID"]
+    try:
+        run_id = redis.Redis(host=host, port=port, decode_responses=True).get("current_run")
+        if run_id:
+            return run_id
+    except Exception:
+        pass
+    manifests = glob.glob(os.path.join(binded_volume, "manifest_*.jsonl"))
+    if not manifests:
+        return None
+    return os.path.basename(max(manifests, key=os.path.getmtime))[len("manifest_"):-len(".jsonl")]
+
+#reading the outputs a run committed from its manifest, a range committed twice is only read once
+def read_manifest(run_id, binded_volume=PROCESS_INFO):
+    outputs = {}
+    manifest = os.path.join(binded_volume, f"manifest_{run_id}.jsonl")
+    if not os.path.exists(manifest):
+        return outputs
+    with open(manifest) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                outputs[record.get("histograms") or record["file"]] = record
+    return outputs
+
+#adding up the histograms of every range the run committed, by category of the samples dict,
+#each category holds the edges, the sums of weights and the sums of squared weights of every histogram
+def merge_histograms(run_id, binded_volume=PROCESS_INFO):
+    category_of = {sample: category for category, info in samples.items() for sample in info['list']}
+    merged = {}
+    for record in read_manifest(run_id, binded_volume).values():
+        if not record.get("histograms") or record["sample"] not in category_of:
+            continue
+        with open(os.path.join(binded_volume, record["histograms"])) as f:
+            partial = json.load(f)["histograms"]
+        category = merged.setdefault(category_of[record["sample"]], {})
+        for name, histogram in partial.items():
+            if name not in category:
+                category[name] = {"edges": [np.array(edges) for edges in histogram["edges"]],
+                                  "sumw": np.zeros(np.shape(histogram["sumw"])),
+                                  "sumw2": np.zeros(np.shape(histogram["sumw2"]))}
+            category[name]["sumw"] += np.array(histogram["sumw"])
+            category[name]["sumw2"] += np.array(histogram["sumw2"])
+    return merged
+
+#the sums of weights, the sums of squared weights and the edges of one histogram of a category,
+#empty for a category with no events
+def category_histogram(histograms, category, name):
+    if name in histograms.get(category, {}):
+        histogram = histograms[category][name]
+        return histogram["sumw"], histogram["sumw2"], histogram["edges"]
+    edges = next(category[name]["edges"] for category in histograms.values() if name in category)
+    shape = tuple(len(axis) - 1 for axis in edges)
+    return np.zeros(shape), np.zeros(shape), edges
+
+def plot_processing_time(binded_volume=PROCESS_INFO, run_id=None):
     # Defining a dictionary to hold the processing time for each worker-sample combination
     processing_durations = {}
 
@@ -100,6 +165,9 @@ def plot_processing_time(binded_volume="/mydir/process_info/"):
         # The files contain processing time data for each worker and sample
         with open(id_file, "r") as file:
             processing_data = json.load(file)  # Load data from the json file
+            # Timing files of earlier runs are left in the directory, only the given run is plotted
+            if run_id is not None and processing_data.get("run_id") != run_id:
+                continue
             # Creating a tuple key of worker ID and sample name
             worker_sample_identifier = (processing_data["worker_id"], processing_data["sample"])
             # Store the processing time in the dictionary
@@ -158,36 +226,29 @@ def plot_processing_time(binded_volume="/mydir/process_info/"):
 
 
 
-#original plotting function: (), for the HZZ analysis 
-def plot_data(data):
-    xmin = 80 * GeV
-    xmax = 250 * GeV
-    step_size = 5 * GeV
-
-    bin_edges = np.arange(start=xmin, # The interval includes this value
-                     stop=xmax+step_size, # The interval doesn't include this value
-                     step=step_size ) # Spacing between values
-    bin_centres = np.arange(start=xmin+step_size/2, # The interval includes this value
-                            stop=xmax+step_size/2, # The interval doesn't include this value
-                            step=step_size ) # Spacing between values
+#original plotting function: (), for the HZZ analysis, drawn from the merged histograms of the workers
+def plot_data(histograms):
+    data_x, _, (bin_edges,) = category_histogram(histograms, 'data', 'mllll') # the data histogram and its bins
+    xmin = bin_edges[0]
+    xmax = bin_edges[-1]
+    step_size = bin_edges[1] - bin_edges[0]
+    bin_centres = (bin_edges[:-1] + bin_edges[1:]) / 2 # the middle of every bin
 
-    data_x,_ = np.histogram(ak.to_numpy(data['data']['mllll']), 
-                            bins=bin_edges ) # histogram the data
     data_x_errors = np.sqrt( data_x ) # statistical error on the data
 
-    signal_x = ak.to_numpy(data[r'Signal ($m_H$ = 125 GeV)']['mllll']) # histogram the signal
-    signal_weights = ak.to_numpy(data[r'Signal ($m_H$ = 125 GeV)'].totalWeight) # get the weights of the signal events
+    signal_x, _, _ = category_histogram(histograms, r'Signal ($m_H$ = 125 GeV)', 'mllll') # the weighted signal histogram
     signal_color = samples[r'Signal ($m_H$ = 125 GeV)']['color'] # get the colour for the signal bar
 
-    mc_x = [] # define list to hold the Monte Carlo histogram entries
-    mc_weights = [] # define list to hold the Monte Carlo weights
+    mc_x = [] # define list to hold the Monte Carlo sums of weights per bin
+    mc_x_err2 = np.zeros(len(bin_centres)) # the Monte Carlo sums of squared weights per bin
     mc_colors = [] # define list to hold the colors of the Monte Carlo bars
     mc_labels = [] # define list to hold the legend labels of the Monte Carlo bars
 
     for s in samples: # loop over samples
         if s not in ['data', r'Signal ($m_H$ = 125 GeV)']: # if not data nor signal
-            mc_x.append( ak.to_numpy(data[s]['mllll']) ) # append to the list of Monte Carlo histogram entries
-            mc_weights.append( ak.to_numpy(data[s].totalWeight) ) # append to the list of Monte Carlo weights
+            sumw, sumw2, _ = category_histogram(histograms, s, 'mllll')
+            mc_x.append( sumw ) # append to the list of Monte Carlo histograms
+            mc_x_err2 += sumw2 # add to the Monte Carlo squared weights
             mc_colors.append( samples[s]['color'] ) # append to the list of Monte Carlo bar colors
             mc_labels.append( s ) # append to the list of Monte Carlo legend labels
 
@@ -201,19 +262,19 @@ def plot_data(data):
                        fmt='ko', # 'k' means black and 'o' is for circles 
                        label='Data') 
     
-    # plot the Monte Carlo bars
-    mc_heights = main_axes.hist(mc_x, bins=bin_edges, 
-                                weights=mc_weights, stacked=True, 
+    # plot the Monte Carlo bars, one entry per bin centre weighted by the bin's sum of weights
+    mc_heights = main_axes.hist([bin_centres] * len(mc_x), bins=bin_edges, 
+                                weights=mc_x, stacked=True, 
                                 color=mc_colors, label=mc_labels )
     
     mc_x_tot = mc_heights[0][-1] # stacked background MC y-axis value
     
     # calculate MC statistical uncertainty: sqrt(sum w^2)
-    mc_x_err = np.sqrt(np.histogram(np.hstack(mc_x), bins=bin_edges, weights=np.hstack(mc_weights)**2)[0])
+    mc_x_err = np.sqrt(mc_x_err2)
     
     # plot the signal bar
-    main_axes.hist(signal_x, bins=bin_edges, bottom=mc_x_tot, 
-                   weights=signal_weights, color=signal_color,
+    main_axes.hist(bin_centres, bins=bin_edges, bottom=mc_x_tot, 
+                   weights=signal_x, color=signal_color,
                    label=r'Signal ($m_H$ = 125 GeV)')
     
     # plot the statistical uncertainty
@@ -280,40 +341,38 @@ def plot_data(data):
     # draw the legend
     main_axes.legend( frameon=False ) # no box around the legend
 
-    plt.savefig("/mydir/process_info/Higgs_Analysis_Plot.png")
+    plt.savefig(os.path.join(PROCESS_INFO, "Higgs_Analysis_Plot.png"))
     
     return
 
 #m12 against m34 plotting function:
-def plot_m12_m34(data):
-    #checking if the Higgs signal data is present in the dataset
-    if r'Signal ($m_H$ = 125 GeV)' in data:
-        #converting the m12 and m34 data to numpy arrays for handling and plotting
-        m12 = ak.to_numpy(data[r'Signal ($m_H$ = 125 GeV)']['m12'])
-        m34 = ak.to_numpy(data[r'Signal ($m_H$ = 125 GeV)']['m34'])
-        #setting up the figure size for the scatter plot
+def plot_m12_m34(histograms):
+    #checking if the Higgs signal histogram is present in the dataset
+    if 'm12_m34' in histograms.get(r'Signal ($m_H$ = 125 GeV)', {}):
+        #the events per m12 and m34 bin, empty bins are left blank
+        counts, _, (m12_edges, m34_edges) = category_histogram(histograms, r'Signal ($m_H$ = 125 GeV)', 'm12_m34')
+        #setting up the figure size for the plot
         plt.figure(figsize=(12, 10))
-        #creating the scatter plot of m12 versus m34
-        #the colour intensity is based on the logarithmic scale of m12 values
-        plt.scatter(m12, m34, alpha=0.6, c=np.log(m12 + 1), cmap='viridis')
+        #creating the 2D histogram of m12 versus m34
+        plt.pcolormesh(m12_edges, m34_edges, np.ma.masked_equal(counts.T, 0), cmap='viridis')
         #setting the x and y labels
         plt.xlabel(r'$m_{12}$ [GeV]', fontsize=14)
         plt.ylabel(r'$m_{34}$ [GeV]', fontsize=14)
         #setting the title of the plot
-        plt.title(r'Scatter plot of $m_{12}$ vs $m_{34}$ for Higgs Signal', fontsize=16)
-        #adding a colour bar to indicate the log scale of m12 values
-        plt.colorbar(label='Log scale of $m_{12}$')
+        plt.title(r'Distribution of $m_{12}$ vs $m_{34}$ for Higgs Signal', fontsize=16)
+        #adding a colour bar to indicate the events per bin
+        plt.colorbar(label='Events')
         #addding grid, minor ticks and applying a tight layout to make the plots look nicer
         plt.grid(True, which='both', linestyle='--', linewidth=0.5)
         plt.minorticks_on()
         plt.tight_layout()
         #saving the plot to a file:
-        plt.savefig('/mydir/process_info/M12_M34_Plot.png')
+        plt.savefig(os.path.join(PROCESS_INFO, 'M12_M34_Plot.png'))
         plt.close()
 
 
 
-def plot_m34(data):
+def plot_m34(histograms):
      #defining meaningful labels for different data categories
     category_labels = {
         'data': 'Observed Data',
@@ -324,17 +383,18 @@ def plot_m34(data):
      #colour palette for different categories
     colors = ['blue', 'purple', 'red', 'cyan', 'orange']
     #iterate through each category of data to create individual plots
-    for i, category in enumerate(data):
+    for i, category in enumerate(samples):
+        #the events per m34 bin for the current category
+        counts, _, (bin_edges,) = category_histogram(histograms, category, 'm34')
         #checking if data present in the current category
-        if len(data[category]) > 0:
-            #converting the m34 data for the current category to a numpy array
-            m34 = ak.to_numpy(data[category]['m34'])
+        if counts.sum() > 0:
              #setting up the figure size for the histogram
             plt.figure(figsize=(12, 10))
             #getting the new labels for the plot
             plot_label = category_labels.get(category, category)
-            # creating a histogram of m34 values
-            plt.hist(m34, bins=50, alpha=0.7, color=colors[i % len(colors)], label=plot_label)
+            # drawing the histogram of m34 values, one entry per bin centre weighted by its count
+            plt.hist((bin_edges[:-1] + bin_edges[1:]) / 2, bins=bin_edges, weights=counts, alpha=0.7,
+                     color=colors[i % len(colors)], label=plot_label)
             # setting the x and y labels of the histogram
             plt.xlabel(r'$m_{34}$ [GeV]', fontsize=14)
             plt.ylabel('Events', fontsize=14)
@@ -347,15 +407,32 @@ def plot_m34(data):
             plt.minorticks_on()
             plt.tight_layout()
             #saving a histogram for the current category, so there will be a file for each category plot
-            plt.savefig(f'/mydir/process_info/M34_distribution_{category}.png')
+            plt.savefig(os.path.join(PROCESS_INFO, f'M34_distribution_{category}.png'))
             plt.close()
 
 
 
 
 if __name__ == "__main__":
-    dictionary_agg = data_aggregation()
-    plot_data(dictionary_agg)
-    plot_m12_m34(dictionary_agg)
-    plot_m34(dictionary_agg)
-    plot_processing_time()
\ No newline at end of file
+    wait_for_run()
+    problems = check_coverage()
+    if problems:
+        print("Coverage ledger shows gaps or overlaps:")
+        for problem in problems:
+            print("\t" + problem)
+        #aggregating an incomplete or double counted run would silently give wrong plots
+        if os.environ.get("ALLOW_PARTIAL_COVERAGE") != "1":
+            sys.exit("Refusing to aggregate, set ALLOW_PARTIAL_COVERAGE=1 to plot anyway")
+        print("Warning: ALLOW_PARTIAL_COVERAGE is set, aggregating anyway")
+
+    run_id = current_run_id()
+    if not read_manifest(run_id):
+        sys.exit(f"No committed outputs found for run {run_id}")
+    #the plots are drawn from the histograms of the workers, the events are never read back
+    histograms = merge_histograms(run_id)
+    if not histograms:
+        sys.exit(f"No histograms found for run {run_id}")
+    plot_data(histograms)
+    plot_m12_m34(histograms)
+    plot_m34(histograms)
+    plot_processing_time(run_id=run_id)
\ No newline at end of file
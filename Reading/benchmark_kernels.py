@@ -0,0 +1,55 @@
+#benchmark of the event kernels of reading.py on one local or remote ROOT file:
+#    python Reading/benchmark_kernels.py <path to a .4lep.root file> <sample> [repeats]
+#the branches are read once, so only the selection, weights and masses are timed
+import sys
+import time
+import uproot
+import awkward as ak
+import numpy as np
+
+import reading
+
+def process(data, sample, kernel):
+    #the per-batch work of read_file for a single-phase read with the given kernel
+    reading.KINEMATICS_KERNEL = kernel
+    data = ak.Array(data)  # a new wrapper, so the fields added here do not reach the next pass
+    xsec_weight = reading.get_xsec_weight(sample) if 'data' not in sample else None
+    passed, _ = reading.evaluate_selection(data)
+    if kernel == "numba":
+        return reading.run_event_kernel(data, xsec_weight, passed)
+    data = data[passed]
+    if xsec_weight is not None:
+        data['totalWeight'] = reading.calc_weight(xsec_weight, data)
+    data['mllll'], data['m12'], data['m34'] = reading.four_lepton_masses(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+    return data
+
+if __name__ == "__main__":
+    path, sample = sys.argv[1], sys.argv[2]
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    branches = reading.CUT_BRANCHES + reading.KINEMATIC_BRANCHES + (reading.WEIGHT_BRANCHES if 'data' not in sample else [])
+    with uproot.open(path + ":mini") as tree:
+        data = tree.arrays(branches, library="ak")
+    print(f"{sample}: {len(data)} events")
+
+    kernels = ["vector", "numpy"] + (["numba"] if reading.numba is not None else [])
+    results = {}
+    for kernel in kernels:
+        #the first call compiles the numba kernel, it is left out of the timing
+        results[kernel] = process(data, sample, kernel)
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            process(data, sample, kernel)
+            times.append(time.perf_counter() - start)
+        print(f"{kernel:>7}: {min(times) * 1000:8.1f} ms per pass, {len(data) / min(times) / 1e6:6.2f} M events/s")
+
+    #every kernel has to keep the same events, the masses agree to float32 rounding
+    for kernel in kernels[1:]:
+        if len(results[kernel]) != len(results["vector"]):
+            print(f"Warning: the {kernel} kernel kept {len(results[kernel])} events, the vector kernel {len(results['vector'])}")
+            continue
+        for field in ('mllll', 'm12', 'm34'):
+            reference, result = ak.to_numpy(results["vector"][field]), ak.to_numpy(results[kernel][field])
+            difference = np.abs(result.astype(np.float64) - reference)
+            print(f"{kernel:>7} {field}: largest difference {difference.max(initial=0):.2e} GeV, "
+                  f"median relative difference {np.median(difference / np.maximum(np.abs(reference), 1e-9)) if len(difference) else 0:.1e}")
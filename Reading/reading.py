@@ -8,6 +8,216 @@ import time
 import awkward as ak
 import os
 import redis  # NEW: Added Redis import
+import socket
+import threading
+import hashlib
+import traceback
+import zlib
+import lzma
+import contextlib
+import shutil
+import urllib.request
+import collections
+import pyarrow.parquet
+
+#compiler for the per-batch event kernel, optional
+try:
+    import numba
+except ImportError:
+    numba = None
+
+#peak memory of the process where /proc is not available, not there on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#fsspec's HTTP client, which is only there when reading over HTTP
+try:
+    import aiohttp
+    HTTPClientError = aiohttp.ClientError
+except ImportError:
+    aiohttp = None
+    HTTPClientError = OSError
+
+#the ROOT file cache locks its entries with flock, which only exists on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+#directory the outputs and timing files are written to, the bind volume inside the containers
+PROCESS_INFO = os.environ.get("PROCESS_INFO", "/mydir/process_info")
+#the plots only need the histograms of each range, set EVENT_OUTPUT=1 to also write the selected events,
+#they are streamed to a Parquet file one row group per batch
+EVENT_OUTPUT = os.environ.get("EVENT_OUTPUT", "0") == "1"
+
+#how long a worker blocks on the work queue before checking whether more tasks are still coming
+QUEUE_WAIT = 5
+
+#shared cache of the remote ROOT files, on the bind volume by default so every worker on the host uses it,
+#set ROOT_CACHE_DIR to an empty string to read straight from the remote files
+CACHE_DIR = os.environ.get("ROOT_CACHE_DIR", os.path.join(PROCESS_INFO, "root_cache"))
+CACHE_MAX_BYTES = int(float(os.environ.get("ROOT_CACHE_MAX_GB", 20)) * 1e9)
+
+#remote reads share one pool of keep-alive connections per worker, at most HTTP_CONNECTIONS at a time,
+#byte ranges closer than COALESCE_GAP bytes are fetched in one request of at most COALESCE_MAX_BYTES
+HTTP_CONNECTIONS = int(os.environ.get("HTTP_CONNECTIONS", 8))
+COALESCE_GAP = int(os.environ.get("COALESCE_GAP", 32 * 1024))
+COALESCE_MAX_RANGES = int(os.environ.get("COALESCE_MAX_RANGES", 1024))
+COALESCE_MAX_BYTES = int(os.environ.get("COALESCE_MAX_BYTES", 10 * 1024 * 1024))
+
+#connections opened, requests sent and bytes received by the pool, read before and after each task
+http_counters = {"handshakes": 0, "requests": 0, "bytes": 0}
+
+#in the two-phase read the cut branches are read first, the kinematics and weights only for the baskets
+#holding events that pass the cuts, set TWO_PHASE_READ=0 to read every branch for every event
+TWO_PHASE_READ = os.environ.get("TWO_PHASE_READ", "1") == "1"
+KINEMATIC_BRANCHES = ['lep_pt', 'lep_eta', 'lep_phi', 'lep_E']
+#only simulated samples are weighted, data samples never read these
+WEIGHT_BRANCHES = ['mcWeight', 'scaleFactor_PILEUP', 'scaleFactor_ELE', 'scaleFactor_MUON', 'scaleFactor_LepTRIGGER']
+#memory held by the arrays of the first batch of a range at most, the batches of the two-phase read cover
+#as many entries as a batch of all the branches would
+STEP_BYTES = 100 * 1024 ** 2
+
+#the memory a worker plans its batches around: MEMORY_BUDGET bytes if set, otherwise MEMORY_FRACTION
+#of the container's memory limit, later batches are sized from the memory the earlier ones took
+MEMORY_BUDGET = int(os.environ.get("MEMORY_BUDGET", 0))
+MEMORY_FRACTION = float(os.environ.get("MEMORY_FRACTION", 0.7))
+MIN_STEP_ENTRIES = int(os.environ.get("MIN_STEP_ENTRIES", 1000))
+
+#trees kept open between tasks, so a worker that reads the same sample again skips the ROOT header reads
+MAX_OPEN_TREES = int(os.environ.get("MAX_OPEN_TREES", 4))
+open_trees = collections.OrderedDict()
+
+#in daemon mode a worker outlives its run: it keeps waiting for the tasks of later runs, with its imports
+#already loaded, until the worker_shutdown key is set
+DAEMON = os.environ.get("WORKER_DAEMON") == "1"
+
+#how often the priority queue is polled while it is empty
+CLAIM_POLL = 0.5
+
+#name of this worker, its claimed tasks are kept in the Redis list processing:<name>
+WORKER_NAME = f"{socket.gethostname()}-{os.getpid()}"
+
+#a worker whose heartbeat is older than this is treated as dead and its tasks are requeued
+VISIBILITY_TIMEOUT = int(os.environ.get("VISIBILITY_TIMEOUT", 120))
+HEARTBEAT_INTERVAL = max(VISIBILITY_TIMEOUT // 4, 1)
+
+#a task that makes no progress for this long is treated as hung, the heartbeat stops so it gets requeued
+STALL_TIMEOUT = int(os.environ.get("STALL_TIMEOUT", 900))
+
+#pops the costliest task and records the claim in the worker's processing list in one step
+CLAIM_PRIORITY_SCRIPT = """
+local popped = redis.call('ZPOPMAX', KEYS[1])
+if popped[1] == nil then
+    return false
+end
+redis.call('LPUSH', KEYS[2], popped[1])
+return popped[1]
+"""
+
+#a task that runs out of memory, or whose worker was killed REAP_SPLIT_AFTER times, is split in halves
+#and requeued, ranges are not split below MIN_SPLIT_ENTRIES entries
+MIN_SPLIT_ENTRIES = int(os.environ.get("MIN_SPLIT_ENTRIES", 1000))
+REAP_SPLIT_AFTER = int(os.environ.get("REAP_SPLIT_AFTER", 2))
+
+#smallest number of entries an idle worker takes over from a running range
+STEAL_MIN_ENTRIES = int(os.environ.get("STEAL_MIN_ENTRIES", 2000))
+
+#finds the running range with the most entries left beyond the batch its worker is reading,
+#moves its end to the middle of what is left and claims the second half as a new task,
+#the owning worker sees the new end after its current batch and stops there,
+#the range keys come from the running set and are not passed in KEYS, see the README on Redis
+STEAL_SCRIPT = """
+local best, best_left, best_from = nil, 0, 0
+for _, key in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local f = redis.call('HMGET', key, 'cursor', 'step', 'end', 'nosteal')
+    if f[3] and not f[4] then
+        local from = tonumber(f[1]) + tonumber(f[2])
+        local left = tonumber(f[3]) - from
+        if left > best_left then
+            best, best_left, best_from = key, left, from
+        end
+    end
+end
+if not best or best_left < 2 * tonumber(ARGV[1]) then
+    return false
+end
+local old_end = tonumber(redis.call('HGET', best, 'end'))
+local split = best_from + math.floor(best_left / 2)
+local sample = redis.call('HGET', best, 'sample')
+redis.call('HSET', best, 'end', split)
+local task_id = sample .. ':' .. split .. '-' .. old_end
+local task = cjson.encode({run_id = ARGV[2], task_id = task_id, sample = sample, start = split,
+                           ['end'] = old_end, worker_id = 1000 + redis.call('HINCRBY', KEYS[4], sample, 1),
+                           cost = 0, stolen_from = redis.call('HGET', best, 'task_id')})
+redis.call('LPUSH', KEYS[2], task)
+redis.call('XADD', KEYS[3], '*', 'type', 'task_added', 'task_id', task_id)
+return task
+"""
+
+#records how far a range has got and returns where it has to stop, the commit key depends on the
+#current end so it is built in the script and not passed in KEYS, see the README on Redis,
+#returns -1 once the manager has requeued the range and removed it, or another worker published it again
+ADVANCE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'worker') ~= ARGV[4] then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'cursor', ARGV[1], 'step', ARGV[2])
+local stop = redis.call('HGET', KEYS[1], 'end')
+if redis.call('EXISTS', ARGV[3] .. stop) == 1 then
+    return tonumber(ARGV[1])
+end
+return tonumber(stop)
+"""
+
+#the commit key of a range names the worker committing it until its outputs and its ledger record are
+#written and is then set to "done", these clear the key of a worker that died in between and record
+#a committed range in the ledger and on the event stream, both only while the key still names the worker
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+FINISH_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('RPUSH', KEYS[2], ARGV[2])
+redis.call('XADD', KEYS[3], '*', unpack(ARGV, 3))
+redis.call('SET', KEYS[1], 'done')
+return 1
+"""
+
+#a task that fails with a transient error is retried this many times in total before it is quarantined,
+#waiting RETRY_BACKOFF seconds before the first retry and twice as long before each one after that
+MAX_ATTEMPTS = int(os.environ.get("MAX_ATTEMPTS", 4))
+RETRY_BACKOFF = float(os.environ.get("RETRY_BACKOFF", 5))
+RETRY_MAX_DELAY = float(os.environ.get("RETRY_MAX_DELAY", 300))
+
+#moves the retries that are due from the retry_queue sorted set back onto the work queue
+PROMOTE_RETRIES_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, task in ipairs(due) do
+    redis.call('ZREM', KEYS[1], task)
+    if ARGV[2] == 'priority' then
+        redis.call('ZADD', KEYS[3], cjson.decode(task)['cost'] or 0, task)
+    else
+        redis.call('RPUSH', KEYS[2], task)
+    end
+end
+return #due
+"""
+
+#time of the last sign of progress, updated by read_file after every batch
+last_progress = time.time()
+
+#ends of the ranges of the current task that were shortened by another worker stealing their second half,
+#keyed by sample and start, a failed task is requeued with these ends so the stolen entries are not read twice
+stolen_ends = {}
 
 
 #here I am getting the directory of the current script reading.py
@@ -19,6 +229,8 @@ directory_after = os.path.dirname(current__script)
 #and here the parent directories path is added so infofile can be imported
 sys.path.append(directory_after)
 import infofile
+#the same file versions as the manager's tree index, so an indexed version is a valid cache key
+from fileversion import file_version
 
 
 #original code, not much changed here:
@@ -111,69 +323,807 @@ def calc_m12_m34(lep_pt, lep_eta, lep_phi, lep_E):
     #returning the calculated invariant masses for later plots
     return m12, m34
 
-def read_file(path, sample, worker_beginning, worker_end, worker_id):
+#the kernel for the lepton cuts and masses: "numpy" works on the first four leptons as fixed-width arrays,
+#"numba" compiles one loop over the events of a batch, "vector" is the original awkward and vector path
+KINEMATICS_KERNEL = os.environ.get("KINEMATICS_KERNEL", "numpy")
+if KINEMATICS_KERNEL == "numba" and numba is None:
+    print("Warning: numba is not installed, using the numpy kernel")
+    KINEMATICS_KERNEL = "numpy"
+
+#the first four leptons of every event as a contiguous (N, 4) NumPy array
+def first_four(leptons):
+    return np.ascontiguousarray(ak.to_numpy(ak.to_regular(leptons[:, :4], axis=1)))
+
+#invariant mass from summed four-momenta, negative for spacelike sums as in vector, in the units of
+#its inputs so the callers convert MeV to GeV, takes arrays or the scalars of the compiled kernel
+def invariant_mass(E, px, py, pz):
+    squared = E ** 2 - px ** 2 - py ** 2 - pz ** 2
+    return np.copysign(np.sqrt(np.absolute(squared)), squared)
+
+#the masks of events kept by each lepton cut, the opposite of cut_lep_charge and cut_lep_type
+def keep_lep_charge(lep_charge):
+    if KINEMATICS_KERNEL == "vector":
+        return ~cut_lep_charge(lep_charge)
+    return first_four(lep_charge).sum(axis=1) == 0
+
+def keep_lep_type(lep_type):
+    if KINEMATICS_KERNEL == "vector":
+        return ~cut_lep_type(lep_type)
+    sum_lep_type = first_four(lep_type).sum(axis=1)
+    return (sum_lep_type == 44) | (sum_lep_type == 48) | (sum_lep_type == 52)
+
+#the cuts by name, each with the branches it reads and the function giving the mask of the events it keeps,
+#a new cut only adds its mask to the selection, the batch is still sliced once
+CUTS = {
+    "lep_charge": (['lep_charge'], keep_lep_charge),
+    "lep_type": (['lep_type'], keep_lep_type),
+}
+#the cuts applied and their order in the cutflow, set SELECTION to a comma-separated list of cut names
+SELECTION = [name for name in os.environ.get("SELECTION", "lep_charge,lep_type").split(",") if name]
+for name in SELECTION:
+    if name not in CUTS:
+        raise ValueError(f"Unknown cut {name!r} in SELECTION, the cuts are {', '.join(CUTS)}")
+#the branches the selection reads, the only ones read for every event in the two-phase read
+CUT_BRANCHES = list(dict.fromkeys(branch for name in SELECTION for branch in CUTS[name][0]))
+
+#evaluating every cut of the selection on its own branches and combining them into one mask,
+#also returns how many events are left after each cut
+def evaluate_selection(data):
+    passed = np.ones(len(data), dtype=bool)
+    cutflow = {}
+    for name in SELECTION:
+        branches, keep = CUTS[name]
+        passed &= ak.to_numpy(keep(*(data[branch] for branch in branches))).astype(bool)
+        cutflow[name] = int(passed.sum())
+    return passed, cutflow
+
+#mllll, m12 and m34 in GeV, the fixed-width path computes px, py, pz and E of the four leptons once for all three
+def four_lepton_masses(lep_pt, lep_eta, lep_phi, lep_E):
+    if KINEMATICS_KERNEL == "vector":
+        return (calc_mllll(lep_pt, lep_eta, lep_phi, lep_E), *calc_m12_m34(lep_pt, lep_eta, lep_phi, lep_E))
+    pt, eta, phi, E = first_four(lep_pt), first_four(lep_eta), first_four(lep_phi), first_four(lep_E)
+    px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+    mllll = invariant_mass(E.sum(axis=1), px.sum(axis=1), py.sum(axis=1), pz.sum(axis=1))
+    m12 = invariant_mass(E[:, :2].sum(axis=1), px[:, :2].sum(axis=1), py[:, :2].sum(axis=1), pz[:, :2].sum(axis=1))
+    m34 = invariant_mass(E[:, 2:].sum(axis=1), px[:, 2:].sum(axis=1), py[:, 2:].sum(axis=1), pz[:, 2:].sum(axis=1))
+    return mllll * MeV, m12 * MeV, m34 * MeV
+
+#one pass over the events of a batch: the total weight and the three masses of every event that passed
+#the selection, written straight into the output arrays, returns the number of events kept
+def event_loop(offsets, passed, pt, eta, phi, E, weights, xsec_weight, kept, masses, total_weight):
+    count = 0
+    for event in range(len(offsets) - 1):
+        if not passed[event]:
+            continue
+        first = offsets[event]
+
+        #four-momentum sums of the first and the second lepton pair
+        E12 = px12 = py12 = pz12 = 0.0
+        E34 = px34 = py34 = pz34 = 0.0
+        for lepton in range(4):
+            i = first + lepton
+            lepton_pt = float(pt[i])
+            lepton_E = float(E[i])
+            lepton_px = lepton_pt * np.cos(float(phi[i]))
+            lepton_py = lepton_pt * np.sin(float(phi[i]))
+            lepton_pz = lepton_pt * np.sinh(float(eta[i]))
+            if lepton < 2:
+                E12 += lepton_E
+                px12 += lepton_px
+                py12 += lepton_py
+                pz12 += lepton_pz
+            else:
+                E34 += lepton_E
+                px34 += lepton_px
+                py34 += lepton_py
+                pz34 += lepton_pz
+        masses[count, 0] = event_mass(E12, px12, py12, pz12) * MeV
+        masses[count, 1] = event_mass(E34, px34, py34, pz34) * MeV
+        masses[count, 2] = event_mass(E12 + E34, px12 + px34, py12 + py34, pz12 + pz34) * MeV
+
+        weight = xsec_weight
+        for factor in range(weights.shape[1]):
+            weight *= weights[event, factor]
+        total_weight[count] = weight
+        kept[count] = event
+        count += 1
+    return count
+
+#event_loop works on one event at a time, with numba it calls a compiled copy of invariant_mass
+#so that the NumPy kernel keeps calling the plain function on whole arrays
+event_mass = invariant_mass
+if numba is not None:
+    event_mass = numba.njit(cache=True)(invariant_mass)
+    event_loop = numba.njit(cache=True)(event_loop)
+
+#running event_loop on the raw buffers of a batch, passed is the selection mask or None when the batch
+#holds only events that already passed it, xsec_weight is None for data samples
+def run_event_kernel(data, xsec_weight, passed=None):
+    offsets = np.concatenate([[0], np.cumsum(ak.to_numpy(ak.num(data.lep_pt)))])
+    flat = {name: ak.to_numpy(ak.flatten(data[name])) for name in KINEMATIC_BRANCHES}
+    if passed is None:
+        passed = np.ones(len(data), dtype=bool)
+    if xsec_weight is None:
+        weights, xsec_weight = np.zeros((len(data), 0)), 1.0
+    else:
+        weights = np.column_stack([ak.to_numpy(data[name]).astype(np.float64) for name in WEIGHT_BRANCHES])
+
+    kept = np.empty(len(data), dtype=np.int64)
+    masses = np.empty((len(data), 3))
+    total_weight = np.empty(len(data))
+    count = event_loop(offsets, passed, flat['lep_pt'], flat['lep_eta'], flat['lep_phi'], flat['lep_E'],
+                       weights, xsec_weight, kept, masses, total_weight)
+
+    #the outputs keep the precision of the branches, as the other kernels do
+    dtype = flat['lep_pt'].dtype
+    data = data[kept[:count]]
+    if weights.shape[1]:
+        data['totalWeight'] = total_weight[:count].astype(dtype)
+    data['mllll'] = masses[:count, 2].astype(dtype)
+    data['m12'] = masses[:count, 0].astype(dtype)
+    data['m34'] = masses[:count, 1].astype(dtype)
+    return data
+
+#the histograms each range fills, by name: the variables, the (low, high, bins) of each of their axes and
+#the field the events are weighted by, data samples have no totalWeight so their events count once each
+HISTOGRAMS = {
+    "mllll": {"variables": ["mllll"], "bins": [(80, 250, 34)], "weight": "totalWeight"},
+    "m34": {"variables": ["m34"], "bins": [(0, 150, 50)], "weight": None},
+    "m12_m34": {"variables": ["m12", "m34"], "bins": [(0, 150, 30), (0, 150, 30)], "weight": None},
+}
+
+#empty sums of weights and of squared weights for every booked histogram
+def book_histograms():
+    histograms = {}
+    for name, booking in HISTOGRAMS.items():
+        edges = [np.linspace(low, high, bins + 1) for low, high, bins in booking["bins"]]
+        shape = tuple(bins for _, _, bins in booking["bins"])
+        histograms[name] = {"variables": booking["variables"], "edges": edges,
+                            "sumw": np.zeros(shape), "sumw2": np.zeros(shape)}
+    return histograms
+
+#adding the selected events of a batch to the histograms, events outside the bins are left out
+def fill_histograms(histograms, data):
+    for name, booking in HISTOGRAMS.items():
+        histogram = histograms[name]
+        values = np.column_stack([ak.to_numpy(data[variable]).astype(np.float64) for variable in booking["variables"]])
+        if booking["weight"] in data.fields:
+            weights = ak.to_numpy(data[booking["weight"]]).astype(np.float64)
+            histogram["sumw"] += np.histogramdd(values, bins=histogram["edges"], weights=weights)[0]
+            histogram["sumw2"] += np.histogramdd(values, bins=histogram["edges"], weights=weights ** 2)[0]
+        else:
+            counts = np.histogramdd(values, bins=histogram["edges"])[0]
+            histogram["sumw"] += counts
+            histogram["sumw2"] += counts
+
+def report_progress():
+    global last_progress
+    last_progress = time.time()
+
+#beats for as long as the worker keeps making progress, a hung read stops the beat
+def heartbeat_loop(r):
+    while True:
+        if time.time() - last_progress < STALL_TIMEOUT:
+            r.set(f"heartbeat:{WORKER_NAME}", time.time(), ex=VISIBILITY_TIMEOUT)
+        time.sleep(HEARTBEAT_INTERVAL)
+
+#claiming a task moves it atomically from the queue into this worker's processing list,
+#so a task is never lost if the worker dies while processing it
+def claim_task(r, processing):
+    #retries whose backoff has passed are claimed before new tasks
+    r.eval(PROMOTE_RETRIES_SCRIPT, 3, "retry_queue", "work_queue", "work_pqueue", time.time(), r.get("queue_mode") or "")
+    if r.get("queue_mode") == "priority":
+        deadline = time.time() + QUEUE_WAIT
+        while time.time() < deadline:
+            work_item_json = r.eval(CLAIM_PRIORITY_SCRIPT, 2, "work_pqueue", processing)
+            if work_item_json:
+                return work_item_json
+            time.sleep(CLAIM_POLL)
+        return None
+    return r.blmove("work_queue", processing, QUEUE_WAIT, "RIGHT", "LEFT")
+
+#errors that are worth retrying: dropped connections, timeouts and corrupted or truncated baskets,
+#a missing file or a bug in the selection fails the same way every time
+def is_transient(error):
+    if isinstance(error, (FileNotFoundError, PermissionError, IsADirectoryError)):
+        return False
+    return isinstance(error, (OSError, HTTPClientError, EOFError, zlib.error, lzma.LZMAError,
+                              uproot.deserialization.DeserializationError))
+
+#replacing a task by its halves on the queue, parts of merged tasks become tasks of their own and
+#parts that were already committed are dropped, returns False if there is nothing left to split,
+#entries other workers stole from the task are not part of the halves
+def split_task(r, processing, work_item_json, reason):
+    work_item = shorten_stolen(json.loads(work_item_json))
+    run_id, task_id = work_item.get("run_id"), work_item.get("task_id", "")
+    parts = [part for part in work_item.get("parts", [work_item])
+             if not range_committed(r, f"commit:{run_id}:{part['sample']}:{part['start']}-{part['end']}")]
+    pieces = []
+    for part in parts:
+        start, end = part["start"], part["end"]
+        if end - start >= 2 * MIN_SPLIT_ENTRIES:
+            middle = (start + end) // 2
+            pieces += [(part["sample"], start, middle), (part["sample"], middle, end)]
+        else:
+            pieces.append((part["sample"], start, end))
+    if len(pieces) < 2:
+        return False
+
+    total = sum(end - start for _, start, end in pieces)
+    priority = r.get("queue_mode") == "priority"
+    #the largest piece of each sample, the manager caps that sample's task size with it in later runs
+    sizes = {}
+    pipe = r.pipeline()
+    for n, (sample, start, end) in enumerate(pieces):
+        sizes[sample] = max(sizes.get(sample, 0), end - start)
+        #ids of the form sample:start-end are taken by stolen tasks, the manager counts each id once
+        piece = {"run_id": run_id, "task_id": f"{task_id}/split{n}:{start}-{end}", "sample": sample,
+                 "start": start, "end": end,
+                 "worker_id": 1000 + r.hincrby(f"stolen_ids:{run_id}", sample),
+                 "cost": work_item.get("cost", 0) * (end - start) / total, "splits": work_item.get("splits", 0) + 1}
+        if priority:
+            pipe.zadd("work_pqueue", {json.dumps(piece): piece["cost"]})
+        else:
+            pipe.rpush("work_queue", json.dumps(piece))
+    if run_id:
+        pipe.xadd(f"events:{run_id}", {"type": "task_split", "task_id": task_id, "worker": WORKER_NAME,
+                                       "pieces": len(pieces), "sizes": json.dumps(sizes), "reason": reason})
+    pipe.lrem(processing, 1, work_item_json)
+    pipe.execute()
+    print(f"Split task {task_id} into {len(pieces)} pieces ({reason})")
+    return True
+
+#moving the ends of the parts of a task to where other workers stole the rest of their ranges,
+#as the manager does for the tasks of a dead worker
+def shorten_stolen(work_item):
+    for part in work_item.get("parts", [work_item]):
+        part["end"] = min(part["end"], stolen_ends.get((part["sample"], part["start"]), part["end"]))
+    return work_item
+
+#a failed task goes back on the queue after a backoff, or into quarantine with its tracebacks
+#once it has used up its attempts or failed in a way a retry would not fix,
+#a task that ran out of memory is split into smaller tasks instead
+def fail_task(r, processing, work_item_json, error):
+    if isinstance(error, MemoryError) and split_task(r, processing, work_item_json, "out of memory"):
+        return
+    work_item = shorten_stolen(json.loads(work_item_json))
+    run_id, task_id = work_item.get("run_id"), work_item.get("task_id", "")
+    work_item["attempts"] = work_item.get("attempts", 0) + 1
+    work_item.setdefault("errors", []).append(traceback.format_exc())
+
+    pipe = r.pipeline()
+    if is_transient(error) and work_item["attempts"] < MAX_ATTEMPTS:
+        delay = min(RETRY_BACKOFF * 2 ** (work_item["attempts"] - 1), RETRY_MAX_DELAY)
+        print(f"Retrying task {task_id} in {delay:.0f}s (attempt {work_item['attempts']} of {MAX_ATTEMPTS})")
+        pipe.zadd("retry_queue", {json.dumps(work_item): time.time() + delay})
+        if run_id:
+            pipe.xadd(f"events:{run_id}", {"type": "task_retry", "task_id": task_id, "worker": WORKER_NAME,
+                                           "attempt": work_item["attempts"], "error": str(error)})
+    else:
+        print(f"Quarantining task {task_id} after {work_item['attempts']} attempts")
+        pipe.lpush("quarantine", json.dumps(work_item))
+        if run_id:
+            pipe.xadd(f"events:{run_id}", {"type": "task_failed", "task_id": task_id, "worker": WORKER_NAME,
+                                           "attempt": work_item["attempts"], "error": str(error)})
+    pipe.lrem(processing, 1, work_item_json)
+    pipe.execute()
+
+#taking over the second half of the largest range another worker is still reading
+def steal_work(r, processing):
+    run_id = r.get("current_run")
+    if not run_id:
+        return None
+    return r.eval(STEAL_SCRIPT, 4, f"running:{run_id}", processing, f"events:{run_id}",
+                  f"stolen_ids:{run_id}", STEAL_MIN_ENTRIES, run_id)
+
+#raised when the manager has given a range this worker is reading to another worker, which happens when
+#the worker's heartbeat lapsed, the task is neither done nor failed as its requeued copy reads it again
+class RangeTakenAway(Exception):
+    pass
+
+#publishing how far a range has got and picking up its end, which may have been moved by steal_work,
+#the range stops where it is once a speculative copy of it has committed its output
+def advance_range(r, range_key, commit_prefix, cursor, step):
+    stop = r.eval(ADVANCE_SCRIPT, 1, range_key, cursor, step, commit_prefix, WORKER_NAME)
+    if stop < 0:
+        raise RangeTakenAway(f"{range_key} was requeued by the manager")
+    return stop
+
+#whether a range is committed or being committed by a live worker, the key of a worker that died before
+#finishing the commit is cleared so that the range is read and committed again, a worker restarted under
+#the same name is not committing anything when it asks
+def range_committed(r, commit_key):
+    owner = r.get(commit_key)
+    if owner is None:
+        return False
+    if owner == "done" or (owner != WORKER_NAME and r.exists(f"heartbeat:{owner}")):
+        return True
+    r.eval(RELEASE_SCRIPT, 1, commit_key, owner)
+    return False
+
+def claim_range(r, commit_key):
+    return not range_committed(r, commit_key) and bool(r.set(commit_key, WORKER_NAME, nx=True))
+
+def finish_range(r, commit_key, run_id, record, event):
+    fields = [str(value) for item in event.items() for value in item]
+    return r.eval(FINISH_SCRIPT, 3, commit_key, f"ledger:{run_id}:done", f"events:{run_id}",
+                  WORKER_NAME, json.dumps(record), *fields)
+
+#the version of a file as recorded in the manager's tree index, None if the file is not indexed
+def indexed_version(r, url):
+    index = r.hget("tree_index", url) if r is not None else None
+    return json.loads(index)["version"] if index else None
+
+#the cache key covers the URL and the file's ETag and size, so a file that changes on the server is fetched again,
+#the manager keeps the versions in the tree index so most tasks skip the HEAD request of file_version
+def cache_key(url, version=None):
+    if version is None:
+        version = file_version(url)
+    return hashlib.sha256(f"{url}\n{version}".encode()).hexdigest()
+
+#removing the least recently used files until the cache fits in CACHE_MAX_BYTES again,
+#files that are being read hold a shared lock and are skipped, and so are partial downloads
+#still being written, those of a worker that was killed while fetching are removed
+def evict_cache():
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith(".part"):
+            with open(os.path.join(CACHE_DIR, name.split(".")[0] + ".lock"), "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                os.remove(os.path.join(CACHE_DIR, name))
+        elif name.endswith(".root"):
+            entry = os.path.join(CACHE_DIR, name)
+            stat = os.stat(entry)
+            entries.append((stat.st_mtime, stat.st_size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= CACHE_MAX_BYTES:
+            break
+        with open(entry[:-len(".root")] + ".lock", "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            os.remove(entry)
+            total -= size
+            print(f"Evicted {os.path.basename(entry)} from the ROOT file cache")
+
+#yields the local copy of a remote ROOT file, fetching it first if no worker has done so yet,
+#the entry stays locked for reading until the caller is done with it
+@contextlib.contextmanager
+def cached_file(url, version=None):
+    if not CACHE_DIR or fcntl is None or not url.startswith(("http://", "https://")):
+        yield url, "off"
+        return
+    try:
+        key = cache_key(url, version)
+    except OSError as e:
+        print(f"Warning: could not check {url} for the ROOT file cache ({e}), reading it remotely")
+        yield url, "off"
+        return
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    entry = os.path.join(CACHE_DIR, key + ".root")
+    with open(os.path.join(CACHE_DIR, key + ".lock"), "a") as lock:
+        #only one worker fetches a file, the others wait on the lock and then find it in the cache
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = "hit" if os.path.exists(entry) else "miss"
+        if state == "hit":
+            os.utime(entry)  # marks the entry as recently used
+        else:
+            print(f"Fetching {url} into the ROOT file cache")
+            partial = f"{entry}.{WORKER_NAME}.part"
+            try:
+                with urllib.request.urlopen(url, timeout=60) as response, open(partial, "wb") as f:
+                    shutil.copyfileobj(response, f, 1 << 20)
+                os.replace(partial, entry)
+            except BaseException:
+                #a failed download leaves nothing in the cache, the next task fetches the file again
+                if os.path.exists(partial):
+                    os.remove(partial)
+                raise
+        fcntl.flock(lock, fcntl.LOCK_SH)
+
+        if state == "miss":
+            with open(os.path.join(CACHE_DIR, ".evict.lock"), "a") as evict_lock:
+                fcntl.flock(evict_lock, fcntl.LOCK_EX)
+                evict_cache()
+        yield entry, state
+
+#the cgroup v2 or v1 memory limit of the container, or the machine's memory outside a container
+def memory_limit():
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        #cgroup v1 reports an unlimited container as a huge number
+        if value != "max" and int(value) < 1 << 60:
+            return int(value)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+def memory_budget():
+    return MEMORY_BUDGET or int(memory_limit() * MEMORY_FRACTION)
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, AttributeError, ValueError):
+        return peak_rss()
+
+#resetting the peak resident memory of the process so the next reading is the peak of one batch
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 if resource else 0
+
+#the entries of the next batch: as many as fit in the memory left, going by the memory each entry of the
+#last batch took at its peak, growing at most twofold from one batch to the next
+def next_step_size(entries, rss_before, peak, budget):
+    per_entry = max(peak - rss_before, 1) / max(entries, 1)
+    room = budget - current_rss()
+    return int(max(MIN_STEP_ENTRIES, min(0.8 * room / per_entry, 2 * entries)))
+
+#reading branches only for the given entries, in spans of whole baskets that hold at least one of them,
+#cells are the entries at which every one of the branches starts a new basket
+def read_survivors(tree, branches, cells, survivors):
+    if len(survivors) == 0:
+        return tree.arrays(branches, library="ak", entry_start=0, entry_stop=0)
+    #the basket cell of every surviving entry, runs of neighbouring cells are read in one go
+    cell = np.searchsorted(cells, survivors, side="right") - 1
+    breaks = np.flatnonzero(np.diff(cell) > 1) + 1
+    parts = []
+    for span in np.split(survivors, breaks):
+        span_start, span_stop = int(span[0]), int(span[-1]) + 1
+        arrays = tree.arrays(branches, library="ak", entry_start=span_start, entry_stop=span_stop)
+        parts.append(arrays[span - span_start])
+    return ak.concatenate(parts) if len(parts) > 1 else parts[0]
+
+async def count_handshake(session, context, params):
+    http_counters["handshakes"] += 1
+
+async def count_request(session, context, params):
+    http_counters["requests"] += 1
+    http_counters["bytes"] += params.response.content_length or 0
+
+#the aiohttp session fsspec uses for every remote file, created once on fsspec's event loop,
+#fsspec keeps one filesystem per set of options so every task and sample shares this session
+async def pooled_client(**kwargs):
+    trace = aiohttp.TraceConfig()
+    trace.on_connection_create_end.append(count_handshake)
+    trace.on_request_end.append(count_request)
+    connector = aiohttp.TCPConnector(limit=HTTP_CONNECTIONS, keepalive_timeout=60)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace], **kwargs)
+
+#the uproot options for a file: memory-mapped from the ROOT file cache, or through the pooled HTTP source
+def source_options(cache_state, path):
+    if cache_state != "off":
+        return {"handler": uproot.MemmapSource}
+    if aiohttp is None or not path.startswith(("http://", "https://")):
+        return {}
+    return {"handler": uproot.source.fsspec.FSSpecSource, "get_client": pooled_client,
+            "coalesce_config": uproot.source.coalesce.CoalesceConfig(
+                max_range_gap=COALESCE_GAP, max_request_ranges=COALESCE_MAX_RANGES,
+                max_request_bytes=COALESCE_MAX_BYTES)}
+
+#an open tree from earlier tasks, or a newly opened one that replaces the least recently used,
+#a tree whose read failed is closed so that the next task opens the file afresh,
+#trees of files in the ROOT file cache are not kept, their memory maps would hold on to the space
+#of files evict_cache removes, and a cached file is opened again without any request
+@contextlib.contextmanager
+def open_tree(path, keep=True, **options):
+    tree = open_trees.pop(path, None)
+    if tree is None:
+        tree = uproot.open(path + ":mini", **options)
+        while len(open_trees) >= MAX_OPEN_TREES:
+            open_trees.popitem(last=False)[1].file.close()
+    try:
+        yield tree
+    except BaseException:
+        tree.file.close()
+        raise
+    if keep:
+        open_trees[path] = tree
+    else:
+        tree.file.close()
+
+#writing the selected events of a range as they are ready, each batch becomes a row group of the Parquet
+#file at path so only one batch is ever held in memory, the file is removed if the read fails
+@contextlib.contextmanager
+def event_writer(path):
+    writer = None
+    def write(array):
+        nonlocal writer
+        table = ak.to_arrow_table(array, extensionarray=True)
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+        writer.write_table(table)
+    try:
+        yield write
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    if writer is not None:
+        writer.close()
+
+def read_file(path, sample, worker_beginning, worker_end, worker_id, run_id=None, on_batch=None, version=None):
     start = time.time() # start the clock
     print("\tProcessing: "+sample) # print which sample is being processed
-    data_all = [] # define empty list to hold all data for this sample
+    # the selected events are written to a hidden file batch by batch, commit_output renames it into place
+    events_file = os.path.join(PROCESS_INFO, f".events_{sample}-{worker_beginning}.{WORKER_NAME}.tmp") if EVENT_OUTPUT else None
+    events_in = events_out = 0 # events read and events passing the cuts
+    cutflow = dict.fromkeys(SELECTION, 0) # events left after each cut of the selection
+    histograms = book_histograms() # filled batch by batch, the events themselves are only written if EVENT_OUTPUT is set
     
-    # open the tree called mini using a context manager (will automatically close files/resources)
-    # The 'mini' tree within the ROOT file is accessed for data analysis
-    with uproot.open(path + ":mini") as tree:
+    # open the tree called mini, kept open for later tasks on the same file unless it comes from the cache
+    # The 'mini' tree within the ROOT file is accessed for data analysis,
+    # a file found in the ROOT file cache is memory-mapped instead of streamed over HTTPS
+    http_before = dict(http_counters)
+    with cached_file(path, version) as (local_path, cache_state), \
+            open_tree(local_path, cache_state == "off", **source_options(cache_state, local_path)) as tree, \
+            (event_writer(events_file) if events_file else contextlib.nullcontext()) as write_events:
+        #the tree may have been read by earlier tasks, only the bytes requested for this range are counted
+        requested_before = tree.file.source.num_requested_bytes
          #checking if the sample is simulated (Monte Carlo) data. If so, calculate the cross-section weight
         if 'data' not in sample: xsec_weight = get_xsec_weight(sample) # get cross-section weight
 
-        #here the data is being iterated over in the tree, this loop processes the data in loads for efficiency
-        
-        for data in tree.iterate(['lep_pt', 'lep_eta', 'lep_phi', 'lep_E', 'lep_charge', 'lep_type', 
-                                  'mcWeight', 'scaleFactor_PILEUP', 'scaleFactor_ELE', 'scaleFactor_MUON', 
-                                  'scaleFactor_LepTRIGGER'],
-                                  library="ak", entry_start=worker_beginning, entry_stop=worker_end):
-            # entry_start and entry_stop define the range of data to process, enabling distributed processing
+        #data samples are never weighted, so their weight branches are not read at all
+        other_branches = KINEMATIC_BRANCHES + (WEIGHT_BRANCHES if 'data' not in sample else [])
+        #without any cuts there is nothing to read first
+        two_phase = TWO_PHASE_READ and bool(CUT_BRANCHES)
+        if two_phase:
+            #only the cut branches are read batch by batch, the others just for the survivors
+            branches = CUT_BRANCHES
+            cells = np.array(tree.common_entry_offsets(filter_name=other_branches))
+        else:
+            branches = CUT_BRANCHES + other_branches
 
-            nIn = len(data) # number of events in this batch
+        #the first batch is sized by uproot's estimate of the arrays of all the branches within a quarter of
+        #the memory budget, every later one by the peak memory the batch before it really took
+        budget = memory_budget()
+        step_size = max(MIN_STEP_ENTRIES, tree.num_entries_for(min(STEP_BYTES, budget // 4),
+                                                               filter_name=CUT_BRANCHES + other_branches,
+                                                               entry_start=worker_beginning, entry_stop=worker_end))
+        step_sizes, peak_memory = [], 0
+
+        #here the data is being read from the tree, this loop processes the data in loads for efficiency
+        batch_start = worker_beginning
+        while batch_start < worker_end:
+            # batch_start and batch_stop define the range of data to process, enabling distributed processing
+            batch_stop = min(batch_start + step_size, worker_end)
+            step_sizes.append(batch_stop - batch_start)
+            rss_before = current_rss()
+            reset_peak_rss()
+            data = tree.arrays(branches, library="ak", entry_start=batch_start, entry_stop=batch_stop)
 
-            if 'data' not in sample: # only do this for Monte Carlo simulation files
-                # multiply all Monte Carlo weights and scale factors together to give total weight
-                data['totalWeight'] = calc_weight(xsec_weight, data)
+            nIn = len(data) # number of events in this batch
 
-            # cut on lepton charge using the function cut_lep_charge defined above
-            data = data[~cut_lep_charge(data.lep_charge)]
+            # every cut of the selection is evaluated on its own branches and combined into one mask
+            passed, batch_cutflow = evaluate_selection(data)
+            for name, count in batch_cutflow.items():
+                cutflow[name] += count
 
-            # cut on lepton type using the function cut_lep_type defined above
-            data = data[~cut_lep_type(data.lep_type)]
+            if two_phase:
+                # the other branches are read for the survivors only
+                survivors = np.flatnonzero(passed) + batch_start
+                cut_data = data[passed]
+                data = read_survivors(tree, other_branches, cells, survivors)
+                for name in CUT_BRANCHES:
+                    data[name] = cut_data[name]
+                passed = None
 
-            # calculation of 4-lepton invariant mass using the function calc_mllll defined above
-            data['mllll'] = calc_mllll(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+            if KINEMATICS_KERNEL == "numba":
+                # the compiled kernel skips the events that failed, and computes the weights and the masses in one loop
+                data = run_event_kernel(data, xsec_weight if 'data' not in sample else None, passed)
+            else:
+                if passed is not None:
+                    # the batch is sliced once by the combined mask of all the cuts
+                    data = data[passed]
 
+                if 'data' not in sample: # only do this for Monte Carlo simulation files
+                    # multiply all Monte Carlo weights and scale factors together to give total weight
+                    data['totalWeight'] = calc_weight(xsec_weight, data)
 
-            #here the invariant masses for two pairs of leptons are calculated
-            m12, m34 = calc_m12_m34(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
-            #done using the calc_m12_m34 function, which takes lepton properties as inputs
-            data['m12'] = m12
-            #store the calculated invariant masses (m12 and m34) back into the data array
-            data['m34'] = m34
+                #here the 4-lepton invariant mass and the invariant masses for two pairs of leptons are calculated
+                mllll, m12, m34 = four_lepton_masses(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+                #done using the four_lepton_masses function, which takes lepton properties as inputs
+                data['mllll'] = mllll
+                data['m12'] = m12
+                #store the calculated invariant masses (m12 and m34) back into the data array
+                data['m34'] = m34
 
             nOut = len(data) # number of events passing cuts in this batch
-            data_all.append(data) # append array from this batch
+            events_in += nIn
+            events_out += nOut
+            fill_histograms(histograms, data) # add this batch to the histograms
+            if write_events is not None:
+                write_events(data) # write this batch as a row group of the events file
+            report_progress() # keeps the heartbeat going
             elapsed = time.time() - start # time taken to process
             print("\t\t nIn: "+str(nIn)+",\t nOut: \t"+str(nOut)+"\t in "+str(round(elapsed,1))+"s") # events before and after
+
+            peak = peak_rss()
+            peak_memory = max(peak_memory, peak)
+            step_size = next_step_size(batch_stop - batch_start, rss_before, peak, budget)
+
+            #another worker may have taken over the end of the range, the batches past it are left to that worker,
+            #the size of the next batch is published so that a steal only splits the range beyond it
+            if on_batch is not None:
+                worker_end = on_batch(batch_stop, step_size)
+            batch_start = batch_stop
+
+        #the number of bytes uproot requested from the file for this range
+        bytes_read = int(tree.file.source.num_requested_bytes - requested_before)
     
     end_time = time.time() #end the clock
     processing_time = end_time - start  #get the processing time for this worker
 
     #the processing time is recorded into a JSON file, they're easy to handle and use 
-    #the file name includes the worker ID and sample name so the user can easily check specific worker data
-    with open(f"/mydir/process_info/new_time_plot_worker{worker_id}_{sample}.json", "w") as f:
+    #the file name includes the worker ID and sample name so the user can easily check specific worker data,
+    #it is written next to its final name and renamed so plotting never reads half of it
+    timing_file = os.path.join(PROCESS_INFO, f"new_time_plot_worker{worker_id}_{sample}.json")
+    with open(f"{timing_file}.{WORKER_NAME}.tmp", "w") as f:
         #writing the processing information as a JSON object
         json.dump({
             "worker_id": worker_id,  #identifier for the specific worker
             "sample": sample,  #sample name
             "time": processing_time, #the time taken for the worker to process that load of the sample
             "worker_beginning": worker_beginning, #the starting entry for the working processes
-            "worker_end": worker_end #the ending entry for the working processes
+            "worker_end": worker_end, #the ending entry for the working processes
+            "run_id": run_id, #the run the task belonged to, used by the manager's cost model
+            "step_sizes": step_sizes, #the entries of every batch, adapted to the memory budget
+            "peak_rss": peak_memory, #the highest resident memory of the worker during the batches, in bytes
+            "memory_budget": budget, #the memory the batches were sized to fit in, in bytes
+            "cutflow": {"all": events_in, **cutflow} #the events read and the events left after each cut
         }, f)
-    #concatenate all the processed data loads/batches into a single awkward array
-    return ak.concatenate(data_all)
+    os.replace(f"{timing_file}.{WORKER_NAME}.tmp", timing_file)
+    #the events file is returned with the task statistics and the histograms, there is no file without EVENT_OUTPUT
+    stats = {"end": worker_end, "events_in": events_in, "events_out": events_out, "bytes_read": bytes_read,
+             "wall_time": processing_time, "cache": cache_state, "cutflow": {"all": events_in, **cutflow},
+             **{f"http_{name}": count - http_before[name] for name, count in http_counters.items()}}
+    return events_file, stats, histograms
+
+
+#outputs are named from the run, the sample and a hash of the range, so a retried range
+#replaces its own file and ranges of earlier runs never mix with this one
+def output_name(run_id, sample, start, end, prefix="reading", extension="awkd"):
+    range_hash = hashlib.sha1(f"{run_id}:{sample}:{start}-{end}".encode()).hexdigest()[:12]
+    return f"{prefix}_{sample}-{run_id}-{range_hash}.{extension}"
+
+#writing the outputs under temporary names, renaming them into place and then listing them in the run's manifest,
+#plotting reads only the files in the manifest so it never sees a half written or stale output
+def commit_output(events_file, histograms, run_id, sample, start, end):
+    #the histograms of the range, a few KB however many events passed
+    histogram_name = output_name(run_id, sample, start, end, "histograms", "json")
+    temp_file = os.path.join(PROCESS_INFO, f".{histogram_name}.{WORKER_NAME}.tmp")
+    with open(temp_file, "w") as f:
+        json.dump({"sample": sample, "start": start, "end": end, "histograms": {
+            name: {"variables": histogram["variables"], "edges": [edges.tolist() for edges in histogram["edges"]],
+                   "sumw": histogram["sumw"].tolist(), "sumw2": histogram["sumw2"].tolist()}
+            for name, histogram in histograms.items()}}, f)
+    os.replace(temp_file, os.path.join(PROCESS_INFO, histogram_name))
+
+    #the selected events, already written batch by batch with EVENT_OUTPUT
+    name = None
+    if events_file is not None:
+        name = output_name(run_id, sample, start, end)
+        os.replace(events_file, os.path.join(PROCESS_INFO, name))
+
+    #a single appended line per output, so concurrent workers never interleave their records
+    record = json.dumps({"sample": sample, "start": start, "end": end, "file": name,
+                         "histograms": histogram_name}) + "\n"
+    manifest = os.open(os.path.join(PROCESS_INFO, f"manifest_{run_id}.jsonl"), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(manifest, record.encode())
+    finally:
+        os.close(manifest)
+    return histogram_name
+
+#processing one entry range of one sample and writing its output
+def process_range(r, run_id, task_id, sample, worker_beginning, worker_end, worker_id, speculative=False):
+    # Use existing info_library creation for the current sample
+    info_library = {sample: "Data/" if 'data' in sample else f"MC/mc_{infofile.infos[sample]['DSID']}." 
+                  for sample in [sample]}
+    
+    capture_file = os.path.join(tuple_path, info_library[sample] + sample + ".4lep.root")
+
+    print(f"Processing {sample} from {worker_beginning} to {worker_end}" + (" (speculative copy)" if speculative else ""))
+    
+    range_key = f"range:{run_id}:{sample}:{worker_beginning}"
+    commit_prefix = f"commit:{run_id}:{sample}:{worker_beginning}-"
+
+    #a retried task skips the ranges it already committed before it failed
+    if r is not None and run_id and range_committed(r, commit_prefix + str(worker_end)):
+        print(f"Skipping {sample} from {worker_beginning} to {worker_end}, already committed")
+        return sample, worker_beginning, worker_end, None
+
+    #the range is published while it runs so that idle workers can take over its second half,
+    #a speculative copy only watches for the original committing first
+    on_batch = None
+    if r is not None and run_id and speculative:
+        on_batch = lambda cursor, step: cursor if r.exists(commit_prefix + str(worker_end)) else worker_end
+    elif r is not None and run_id:
+        r.hset(range_key, mapping={"sample": sample, "task_id": task_id, "start": worker_beginning, "end": worker_end,
+                                   "cursor": worker_beginning, "step": worker_end - worker_beginning,
+                                   "worker_id": worker_id, "worker": WORKER_NAME, "started": time.time()})
+        r.sadd(f"running:{run_id}", range_key)
+        on_batch = lambda cursor, step: advance_range(r, range_key, commit_prefix, cursor, step)
+
+    # Process using existing read_file function
+    planned_end = worker_end
+    reading_file = None
+    try:
+        reading_file, stats, histograms = read_file(capture_file, sample, worker_beginning, worker_end, worker_id, run_id, on_batch,
+                                        indexed_version(r, capture_file))
+    finally:
+        if on_batch is not None and not speculative:
+            #a range the manager requeued while it was read is left to the requeued copy, whatever this one read
+            planned_end, owner = r.hmget(range_key, "end", "worker")
+            if owner != WORKER_NAME:
+                if reading_file is not None:
+                    os.remove(reading_file)
+                raise RangeTakenAway(f"{range_key} was requeued by the manager")
+            #the range may have been shortened by another worker stealing its end
+            planned_end = int(planned_end)
+            if planned_end < worker_end:
+                stolen_ends[(sample, worker_beginning)] = planned_end
+            r.srem(f"running:{run_id}", range_key)
+            r.delete(range_key)
+    worker_end = stats.pop("end")
+
+    if r is not None and run_id:
+        #the first copy of a range to finish wins, a copy that was stopped early or
+        #finishes second throws its output away so the range is never counted twice
+        if worker_end < planned_end or not claim_range(r, commit_prefix + str(planned_end)):
+            print(f"Discarding {sample} from {worker_beginning} to {planned_end}, another copy finished first")
+            if reading_file is not None:
+                os.remove(reading_file)
+            return sample, worker_beginning, planned_end, None
+
+    commit_output(reading_file, histograms, run_id or "local", sample, worker_beginning, worker_end)
+
+    #the finished range is recorded in the run's coverage ledger and published on the run's event stream
+    #after its outputs are in place, only then is it marked done, local runs have no Redis and leave this
+    #to the manager
+    if r is not None and run_id:
+        if not finish_range(r, commit_prefix + str(worker_end), run_id,
+                            {"sample": sample, "start": worker_beginning, "end": worker_end},
+                            {"type": "range", "task_id": task_id, "sample": sample,
+                             "start": worker_beginning, "end": worker_end,
+                             **stats, "cutflow": json.dumps(stats["cutflow"])}):
+            print(f"Lost the commit of {sample} from {worker_beginning} to {worker_end} to another copy")
+            return sample, worker_beginning, worker_end, None
+    print(f"Completed task for {sample}")
+    return sample, worker_beginning, worker_end, stats
+
+#processing every range of a task, merged tasks carry several small ranges in "parts"
+def run_task(work_item, r=None):
+    return [process_range(r, work_item.get("run_id"), work_item.get("task_id"), part["sample"],
+                          part["start"], part["end"], part["worker_id"], work_item.get("speculative", False))
+            for part in work_item.get("parts", [work_item])]
 
 
 if __name__ == "__main__":
@@ -187,40 +1137,62 @@ if __name__ == "__main__":
         print(f"Failed to connect to Redis: {str(e)}")
         sys.exit(1)
 
-    print("Worker started, waiting for tasks...")
+    #registering the worker and starting its heartbeat so the manager can requeue its tasks if it dies
+    processing = f"processing:{WORKER_NAME}"
+    r.sadd("workers", WORKER_NAME)
+    r.set(f"heartbeat:{WORKER_NAME}", time.time(), ex=VISIBILITY_TIMEOUT)
+    threading.Thread(target=heartbeat_loop, args=(r,), daemon=True).start()
+
+    print(f"Worker {WORKER_NAME} started{' as a daemon' if DAEMON else ''}, waiting for tasks...")
 
     while True:
         try:
-            # Try to get work from queue
-            work_item_json = r.rpop("work_queue")
+            # Try to get work from queue, blocking until a task shows up
+            work_item_json = None
+            stolen_ends.clear()
+            report_progress()
+            #a daemon finishes the task it is on and then stops when asked to
+            if DAEMON and r.exists("worker_shutdown"):
+                print("Shutdown requested")
+                r.srem("workers", WORKER_NAME)
+                break
+            work_item_json = claim_task(r, processing)
+            if not work_item_json:
+                #helping with the largest range still running before waiting or giving up
+                work_item_json = steal_work(r, processing)
             if not work_item_json:
+                #the manager may still be streaming tasks into the queue, or requeue and
+                #duplicate running tasks until it marks the run as finished
+                if DAEMON or r.get("queue_status") in ("building", "complete"):
+                    continue
                 print("No more work available")
+                r.srem("workers", WORKER_NAME)
                 break
 
             print(f"Received task: {work_item_json}")
             
             # Process the work item
             work_item = json.loads(work_item_json)
-            sample = work_item["sample"]
-            worker_beginning = work_item["start"]
-            worker_end = work_item["end"]
-            worker_id = work_item["worker_id"]
-
-            # Use existing info_library creation for the current sample
-            info_library = {sample: "Data/" if 'data' in sample else f"MC/mc_{infofile.infos[sample]['DSID']}." 
-                          for sample in [sample]}
-            
-            capture_file = os.path.join(tuple_path, info_library[sample] + sample + ".4lep.root")
+            run_id, task_id = work_item.get("run_id"), work_item.get("task_id")
+            #a worker killed while holding this task was most likely killed for memory
+            if work_item.get("reaped", 0) >= REAP_SPLIT_AFTER and \
+                    split_task(r, processing, work_item_json, f"worker lost {work_item['reaped']} times"):
+                continue
+            run_task(work_item, r)
 
-            print(f"Processing {sample} from {worker_beginning} to {worker_end}")
-            
-            # Process using existing read_file function
-            reading_file = read_file(capture_file, sample, worker_beginning, worker_end, worker_id)
-            writing_file = f"/mydir/process_info/reading_{sample}-{worker_beginning}-{worker_end}.awkd"
-            ak.to_parquet(reading_file, writing_file)
-            print(f"Completed task for {sample}")
+            #the task is only finished once it leaves the processing list
+            pipe = r.pipeline()
+            if run_id:
+                pipe.xadd(f"events:{run_id}", {"type": "task_done", "task_id": task_id, "worker": WORKER_NAME})
+            pipe.lrem(processing, 1, work_item_json)
+            pipe.execute()
+
+        except RangeTakenAway as e:
+            #the manager already put the task back on the queue, it is not counted as done or failed
+            print(f"Stopped task: {e}")
+            r.lrem(processing, 1, work_item_json)
 
         except Exception as e:
             print(f"Error processing task: {str(e)}")
             if work_item_json:
-                r.lpush("failed_queue", work_item_json)
\ No newline at end of file
+                fail_task(r, processing, work_item_json, e)
\ No newline at end of file
@@ -0,0 +1,13 @@
+"""Version of a ROOT file, shared by the manager's tree index and the workers' ROOT file cache"""
+
+import os
+import urllib.request
+
+#the ETag and size of a remote file, or the modification time and size of a local one,
+#a file whose version changes is indexed and cached again
+def file_version(url):
+    if url.startswith(("http://", "https://")):
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=30) as response:
+            return f"{response.headers.get('ETag', '')}:{response.headers.get('Content-Length', '')}"
+    stat = os.stat(url)
+    return f"{stat.st_mtime_ns}:{stat.st_size}"
@@ -0,0 +1,54 @@
+#fixtures shared by the tests that run the worker against fakeredis and a small ROOT file
+import os
+import sys
+
+import awkward as ak
+import numpy as np
+import pytest
+
+directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(directory, "Manager"))
+sys.path.append(os.path.join(directory, "Plotting"))
+sys.path.append(os.path.join(directory, "Reading"))
+
+ENTRIES = 40000
+
+#a Redis server in memory, the Lua scripts need fakeredis[lua]
+@pytest.fixture
+def r():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return fakeredis.FakeRedis(decode_responses=True)
+
+#a directory laid out like tuple_path with one data tuple of the branches the worker reads,
+#written in baskets of 5000 entries
+@pytest.fixture(scope="session")
+def tuple_dir(tmp_path_factory):
+    uproot = pytest.importorskip("uproot")
+    path = tmp_path_factory.mktemp("tuples")
+    os.makedirs(path / "Data")
+    rng = np.random.default_rng(1)
+    with uproot.recreate(str(path / "Data" / "data_A.4lep.root")) as f:
+        for chunk in range(ENTRIES // 5000):
+            counts = rng.integers(4, 6, 5000)
+            total = counts.sum()
+            lep = {"lep_pt": rng.uniform(7e3, 1e5, total).astype(np.float32),
+                   "lep_eta": rng.uniform(-2.5, 2.5, total).astype(np.float32),
+                   "lep_phi": rng.uniform(-3.1, 3.1, total).astype(np.float32),
+                   "lep_charge": rng.choice([-1, 1], total).astype(np.int32),
+                   "lep_type": rng.choice([11, 13], total).astype(np.uint32)}
+            lep["lep_E"] = lep["lep_pt"] * np.cosh(lep["lep_eta"]) * np.float32(1.0001)
+            branches = {name: ak.unflatten(values, counts) for name, values in lep.items()}
+            if chunk == 0:
+                f.mktree("mini", {name: array.type for name, array in branches.items()})
+            f["mini"].extend(branches)
+    return str(path) + "/"
+
+#a worker reading the tuples of tuple_dir and writing its outputs to a temporary process_info
+@pytest.fixture
+def worker(monkeypatch, tmp_path, tuple_dir):
+    import reading
+    monkeypatch.setattr(reading, "tuple_path", tuple_dir)
+    monkeypatch.setattr(reading, "PROCESS_INFO", str(tmp_path))
+    reading.open_trees.clear()
+    return reading
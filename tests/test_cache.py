@@ -0,0 +1,56 @@
+#tests of the workers' ROOT file cache, with the tuples served over HTTP from a local server:
+#    python -m pytest tests
+import fcntl
+import functools
+import http.server
+import os
+import threading
+
+import pytest
+
+import reading
+
+
+@pytest.fixture
+def server(tuple_dir):
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=tuple_dir)
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}/"
+    httpd.shutdown()
+
+@pytest.fixture
+def cache(worker, monkeypatch, tmp_path):
+    cache_dir = tmp_path / "root_cache"
+    monkeypatch.setattr(reading, "CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+#a cached file is memory-mapped for the task and closed after it, so eviction can free its space
+def test_cached_trees_are_not_kept_open(server, cache):
+    url = server + "Data/data_A.4lep.root"
+    _, stats, _ = reading.read_file(url, "data_A", 0, 1000, 1, version="v1")
+    assert stats["cache"] == "miss" and reading.open_trees == {}
+    _, stats, _ = reading.read_file(url, "data_A", 0, 1000, 1, version="v1")
+    assert stats["cache"] == "hit" and reading.open_trees == {}
+    assert [name.split(".", 1)[1] for name in os.listdir(cache) if not name.endswith(".lock")] == ["root"]
+
+#a download that fails halfway leaves no partial file behind
+def test_failed_fetch_removes_the_partial_file(server, cache, monkeypatch):
+    def copyfileobj(source, target, length):
+        target.write(source.read(1000))
+        raise ConnectionResetError("reset")
+    monkeypatch.setattr(reading.shutil, "copyfileobj", copyfileobj)
+    with pytest.raises(ConnectionResetError):
+        reading.read_file(server + "Data/data_A.4lep.root", "data_A", 0, 1000, 1, version="v1")
+    assert [name for name in os.listdir(cache) if not name.endswith(".lock")] == []
+
+#eviction removes the partial files of workers that were killed while fetching,
+#but not one that is still being written under its entry's lock
+def test_evict_removes_abandoned_partial_files(cache):
+    os.makedirs(cache)
+    for key in ("abandoned", "fetching"):
+        (cache / f"{key}.root.worker-a.part").write_bytes(b"partial")
+    with open(cache / "fetching.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        reading.evict_cache()
+    assert sorted(name for name in os.listdir(cache) if name.endswith(".part")) == ["fetching.root.worker-a.part"]
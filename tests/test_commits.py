@@ -0,0 +1,81 @@
+#tests of how a worker commits a range: the claim, the outputs and manifest, and the ledger record,
+#run against fakeredis:
+#    python -m pytest tests
+import json
+
+from conftest import ENTRIES
+import plotting
+import reading
+
+COMMIT = "commit:run:data_A:0-" + str(ENTRIES)
+
+
+def ledger(r):
+    return [json.loads(record) for record in r.lrange("ledger:run:done", 0, -1)]
+
+#a committed range is written out, recorded in the ledger and published once, and then marked done
+def test_process_range_commits_once(r, worker):
+    sample, start, end, stats = worker.process_range(r, "run", "data_A:0-40000", "data_A", 0, ENTRIES, 1)
+    assert (start, end, stats["events_in"]) == (0, ENTRIES, ENTRIES)
+    assert r.get(COMMIT) == "done"
+    assert ledger(r) == [{"sample": "data_A", "start": 0, "end": ENTRIES}]
+    assert [fields["type"] for _, fields in r.xrange("events:run")] == ["range"]
+    assert worker.process_range(r, "run", "data_A:0-40000", "data_A", 0, ENTRIES, 1)[3] is None
+    assert len(ledger(r)) == 1
+
+#a worker that died after claiming a range but before recording it leaves its name in the commit key,
+#the retry clears the claim and commits the range again so the ledger has no gap
+def test_retry_recommits_a_range_left_by_a_dead_worker(r, worker):
+    r.set(COMMIT, "worker-dead")
+    stats = worker.process_range(r, "run", "data_A:0-40000", "data_A", 0, ENTRIES, 1)[3]
+    assert stats is not None
+    assert r.get(COMMIT) == "done"
+    assert ledger(r) == [{"sample": "data_A", "start": 0, "end": ENTRIES}]
+
+#a claim by a live worker stands, and a claim under the worker's own name is left from before it restarted
+def test_range_committed_follows_the_claim(r, monkeypatch):
+    monkeypatch.setattr(reading, "WORKER_NAME", "worker-a")
+    assert not reading.range_committed(r, COMMIT)
+    r.set(COMMIT, "done")
+    assert reading.range_committed(r, COMMIT)
+    r.set(COMMIT, "worker-b")
+    r.set("heartbeat:worker-b", 1)
+    assert reading.range_committed(r, COMMIT)
+    r.delete("heartbeat:worker-b")
+    assert not reading.range_committed(r, COMMIT) and not r.exists(COMMIT)
+    r.set(COMMIT, "worker-a")
+    r.set("heartbeat:worker-a", 1)
+    assert not reading.range_committed(r, COMMIT)
+    assert reading.claim_range(r, COMMIT) and r.get(COMMIT) == "worker-a"
+
+#a worker whose claim was cleared and taken over does not record the range a second time
+def test_finish_range_needs_the_claim(r, monkeypatch):
+    monkeypatch.setattr(reading, "WORKER_NAME", "worker-a")
+    r.set(COMMIT, "worker-b")
+    record = {"sample": "data_A", "start": 0, "end": ENTRIES}
+    assert not reading.finish_range(r, COMMIT, "run", record, {"type": "range"})
+    assert ledger(r) == [] and r.xlen("events:run") == 0
+    r.set(COMMIT, "worker-a")
+    assert reading.finish_range(r, COMMIT, "run", record, {"type": "range", "events_in": 5})
+    assert ledger(r) == [record] and r.get(COMMIT) == "done"
+    assert r.xrange("events:run")[0][1] == {"type": "range", "events_in": "5"}
+
+#the outputs are renamed into place and listed once per commit in the run's manifest,
+#plotting reads a range committed twice only once and never sees the temporary files
+def test_commit_output_lists_the_outputs_in_the_manifest(worker, tmp_path):
+    histograms = worker.book_histograms()
+    events_file = tmp_path / ".events_data_A-0.tmp"
+    events_file.write_bytes(b"events")
+    name = worker.commit_output(str(events_file), histograms, "run", "data_A", 0, 100)
+    worker.commit_output(None, histograms, "run", "data_A", 0, 100)
+    worker.commit_output(None, histograms, "run", "data_A", 100, 200)
+
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [name, worker.output_name("run", "data_A", 100, 200, "histograms", "json"),
+         worker.output_name("run", "data_A", 0, 100), "manifest_run.jsonl"])
+    with open(tmp_path / name) as f:
+        assert json.load(f)["histograms"].keys() == worker.HISTOGRAMS.keys()
+    with open(tmp_path / "manifest_run.jsonl") as f:
+        assert len(f.readlines()) == 3
+    outputs = plotting.read_manifest("run", str(tmp_path))
+    assert sorted((record["start"], record["end"]) for record in outputs.values()) == [(0, 100), (100, 200)]
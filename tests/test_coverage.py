@@ -0,0 +1,45 @@
+#tests of the coverage ledger the manager and plotting check a run against, run against fakeredis:
+#    python -m pytest tests
+import json
+
+import pytest
+
+import manager
+import plotting
+
+
+def record(r, run_id, sample, start, end):
+    r.rpush(f"ledger:{run_id}:done", json.dumps({"sample": sample, "start": start, "end": end}))
+
+def test_coverage_problems_finds_gaps_and_overlaps(r):
+    r.hset("ledger:run:expected", mapping={"data_A": 100, "data_B": 50})
+    for start, end in [(0, 40), (40, 100)]:
+        record(r, "run", "data_A", start, end)
+    assert plotting.coverage_problems(r, "run") == ["data_B: entries 0-50 were not read"]
+    for start, end in [(0, 30), (20, 40)]:
+        record(r, "run", "data_B", start, end)
+    record(r, "run", "data_C", 0, 10)
+    assert plotting.coverage_problems(r, "run") == [
+        "data_B: entries 20-30 were read more than once", "data_B: entries 40-50 were not read",
+        "data_C: ranges were read for a sample that is not part of the run"]
+
+#a sample whose header could not be read has no tasks and no expected entries, but the run is still incomplete
+def test_unplanned_sample_keeps_the_run_incomplete(r, monkeypatch):
+    def enumerate_samples(samples, max_open, r):
+        yield "data_A", {"entries": 0, "source": "header"}, None
+        yield "data_B", None, OSError("connection reset")
+    monkeypatch.setattr(manager, "enumerate_samples", enumerate_samples)
+    assert manager.prepare_work_queue(r, ["data_A", "data_B"], 2, "run", model={}) == (0, [])
+    assert r.hgetall("ledger:run:expected") == {"data_A": "0"}
+    assert r.smembers("ledger:run:unplanned") == {"data_B"}
+    assert plotting.coverage_problems(r, "run") == [
+        "data_B: not read, the manager could not read its header to plan its tasks"]
+
+#plotting only checks the ledger after the run is finished, so the gaps are reported at once without waiting
+def test_check_coverage_reports_gaps_once(r, monkeypatch):
+    monkeypatch.setattr(plotting.redis, "Redis", lambda **kwargs: r)
+    monkeypatch.setattr(plotting.time, "sleep", lambda seconds: pytest.fail("check_coverage waited"))
+    r.set("current_run", "run")
+    r.hset("ledger:run:expected", "data_A", 100)
+    record(r, "run", "data_A", 0, 60)
+    assert plotting.check_coverage() == ["data_A: entries 60-100 were not read"]
@@ -0,0 +1,149 @@
+#tests of the pure helpers the task planning and the event selection depend on,
+#they need neither Redis nor ROOT files:
+#    python -m pytest tests
+import os
+import sys
+import json
+import math
+
+import awkward as ak
+import numpy as np
+import pytest
+
+directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.append(os.path.join(directory, "Manager"))
+sys.path.append(os.path.join(directory, "Reading"))
+import manager
+import reading
+
+
+#every entry belongs to exactly one range and the range sizes differ by at most one
+@pytest.mark.parametrize("entries, n_tasks", [(10, 3), (40000, 7), (5, 5), (3, 8), (1, 1)])
+def test_partition_entries_tiles_exactly(entries, n_tasks):
+    cuts = manager.partition_entries(entries, n_tasks)
+    manager.check_coverage(cuts, entries)
+    sizes = [b - a for a, b in zip(cuts[:-1], cuts[1:])]
+    assert sum(sizes) == entries
+    assert max(sizes) - min(sizes) <= 1
+    assert len(sizes) == min(n_tasks, entries)
+
+def test_check_coverage_rejects_gaps_and_overlaps():
+    with pytest.raises(ValueError):
+        manager.check_coverage([0, 5, 9], 10)
+    with pytest.raises(ValueError):
+        manager.check_coverage([1, 5, 10], 10)
+    with pytest.raises(ValueError):
+        manager.check_coverage([0, 5, 5, 10], 10)
+    with pytest.raises(ValueError):
+        manager.check_coverage([0, 6, 4, 10], 10)
+
+#interior cuts move to the nearest basket boundary, the ends stay and no range becomes empty
+def test_align_cuts_snaps_to_baskets():
+    boundaries = [0, 100, 250, 400, 1000]
+    assert manager.align_cuts([0, 240, 480, 1000], boundaries) == [0, 250, 400, 1000]
+    #two cuts snapping onto the same boundary are merged
+    assert manager.align_cuts([0, 240, 260, 1000], boundaries) == [0, 250, 1000]
+    #a cut snapping onto an end is dropped
+    assert manager.align_cuts([0, 20, 1000], boundaries) == [0, 1000]
+    aligned = manager.align_cuts(manager.partition_entries(1000, 6), boundaries)
+    manager.check_coverage(aligned, 1000)
+    assert all(cut in boundaries for cut in aligned)
+
+def test_update_cost_model_learns_each_run_once(tmp_path):
+    def timing(name, run_id, sample, seconds, start, end):
+        with open(tmp_path / f"new_time_plot_worker{name}_{sample}.json", "w") as f:
+            json.dump({"worker_id": name, "sample": sample, "time": seconds, "run_id": run_id,
+                       "worker_beginning": start, "worker_end": end}, f)
+
+    timing(1, "run1", "Zee", 2.0, 0, 1000)
+    timing(2, "run1", "Zee", 2.0, 1000, 2000)
+    model = {"samples": {}, "learned_runs": [], "max_task_entries": {}}
+    assert manager.update_cost_model(model, str(tmp_path)) == 1
+    assert model["samples"]["Zee"] == {"seconds_per_entry": pytest.approx(0.002), "runs": 1}
+    #the same files are not learned twice
+    assert manager.update_cost_model(model, str(tmp_path)) == 0
+
+    #a new run moves the rate by LEARNING_RATE towards what it observed
+    timing(1, "run2", "Zee", 4.0, 0, 1000)
+    timing(2, "run2", "Zee", 4.0, 1000, 2000)
+    manager.update_cost_model(model, str(tmp_path))
+    expected = (1 - manager.LEARNING_RATE) * 0.002 + manager.LEARNING_RATE * 0.004
+    assert model["samples"]["Zee"]["seconds_per_entry"] == pytest.approx(expected)
+    assert model["samples"]["Zee"]["runs"] == 2
+
+def test_plan_task_count_uses_rate_and_cap():
+    model = {"samples": {"llll": {"seconds_per_entry": 0.01, "runs": 1}}, "learned_runs": []}
+    #100000 entries at 0.01 s are 1000 s, cut into tasks of 60 s
+    assert manager.plan_task_count(model, "llll", 100000, 4, target=60) == math.ceil(1000 / 60)
+    #never smaller than MIN_TASK_ENTRIES entries per task
+    assert manager.plan_task_count(model, "llll", 2 * manager.MIN_TASK_ENTRIES, 4, target=1) == 2
+    #samples the model has not seen are spread over the workers
+    assert manager.plan_task_count(model, "Zee", 100000, 4) == 4
+
+    #a cap learned from split tasks raises the count so no task is larger than the cap
+    manager.update_task_caps(model, {"llll": 3000})
+    assert manager.plan_task_count(model, "llll", 100000, 4, target=60) == math.ceil(100000 / 3000)
+    #caps only come down
+    manager.update_task_caps(model, {"llll": 5000})
+    assert manager.max_task_entries(model, "llll") == 3000
+    #a cap above the planned size changes nothing
+    manager.update_task_caps(model, {"Zee": 10 ** 6})
+    assert manager.plan_task_count(model, "Zee", 100000, 4) == 4
+
+def test_predict_makespan_is_lpt():
+    #longest first: 3 and 3 on the two workers, then 2 on each, the last 2 ends at 7
+    assert manager.predict_makespan([2, 3, 2, 3, 2], 2) == 7
+    assert manager.predict_makespan([5, 1, 1, 1], 4) == 5
+    assert manager.predict_makespan([1, 1, 1, 1], 1) == 4
+    assert manager.predict_makespan([], 3) == 0
+
+
+#four events of four or five leptons: the first passes both cuts, the second fails the charge cut,
+#the third fails the type cut and the fourth has a fifth lepton that the cuts ignore
+def lepton_events():
+    return ak.Array({
+        "lep_charge": [[1, -1, 1, -1], [1, 1, 1, -1], [1, -1, 1, -1], [-1, 1, -1, 1, 1]],
+        "lep_type": [[11, 11, 13, 13], [11, 11, 11, 11], [11, 13, 13, 13], [13, 13, 13, 13, 11]],
+        "lep_pt": [[40e3, 30e3, 20e3, 10e3], [50e3, 25e3, 15e3, 12e3], [60e3, 45e3, 30e3, 8e3],
+                   [35e3, 33e3, 21e3, 9e3, 7e3]],
+        "lep_eta": [[0.1, -0.5, 1.2, -2.0], [0.0, 0.3, -0.3, 1.0], [2.1, -1.1, 0.4, 0.0], [-0.2, 0.7, 1.5, -1.3, 0.2]],
+        "lep_phi": [[0.0, 2.0, -1.0, 3.0], [1.0, -2.5, 0.5, 2.0], [-3.0, 0.2, 1.7, -0.9], [0.3, -1.4, 2.6, -2.2, 1.0]],
+        "lep_E": [[45e3, 40e3, 40e3, 40e3], [51e3, 27e3, 16e3, 19e3], [250e3, 76e3, 33e3, 8e3],
+                  [36e3, 42e3, 50e3, 18e3, 8e3]],
+    })
+
+@pytest.fixture(params=["numpy", "vector"])
+def kernel(request, monkeypatch):
+    monkeypatch.setattr(reading, "KINEMATICS_KERNEL", request.param)
+    return request.param
+
+def test_lepton_cuts(kernel):
+    data = lepton_events()
+    assert ak.to_list(reading.keep_lep_charge(data.lep_charge)) == [True, False, True, True]
+    assert ak.to_list(reading.keep_lep_type(data.lep_type)) == [True, True, False, True]
+    passed, cutflow = reading.evaluate_selection(data)
+    assert passed.tolist() == [True, False, False, True]
+    assert cutflow == {"lep_charge": 3, "lep_type": 2}
+
+def test_numpy_masses_match_vector(monkeypatch):
+    data = lepton_events()
+    fields = (data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+    monkeypatch.setattr(reading, "KINEMATICS_KERNEL", "vector")
+    expected = [ak.to_numpy(mass) for mass in reading.four_lepton_masses(*fields)]
+    monkeypatch.setattr(reading, "KINEMATICS_KERNEL", "numpy")
+    result = reading.four_lepton_masses(*fields)
+    for name, e, r in zip(("mllll", "m12", "m34"), expected, result):
+        np.testing.assert_allclose(r, e, rtol=1e-9, atol=1e-9, err_msg=name)
+
+#the event loop, compiled when numba is installed, keeps the events that pass and agrees with the NumPy masses
+def test_event_kernel_matches_numpy(monkeypatch):
+    data = lepton_events()
+    monkeypatch.setattr(reading, "KINEMATICS_KERNEL", "numpy")
+    passed, _ = reading.evaluate_selection(data)
+    expected = reading.four_lepton_masses(data.lep_pt, data.lep_eta, data.lep_phi, data.lep_E)
+    result = reading.run_event_kernel(data, None, passed)
+    assert len(result) == 2 and "totalWeight" not in result.fields
+    for name, e in zip(("mllll", "m12", "m34"), expected):
+        np.testing.assert_allclose(ak.to_numpy(result[name]), e[passed], rtol=1e-9, err_msg=name)
+    #the NumPy kernel still calls the plain function on whole arrays
+    assert reading.invariant_mass(np.array([5.0]), np.array([3.0]), np.zeros(1), np.zeros(1)).tolist() == [4.0]
@@ -0,0 +1,63 @@
+#tests of the histograms the workers fill batch by batch and plotting adds up by category:
+#    python -m pytest tests
+import awkward as ak
+import numpy as np
+import pytest
+
+import plotting
+import reading
+
+
+def selected_events(weights=None):
+    events = {"mllll": [100.0, 125.0, 125.5, 300.0], "m12": [90.0, 91.0, 20.0, 10.0], "m34": [30.0, 31.0, 149.0, 160.0]}
+    if weights is not None:
+        events["totalWeight"] = weights
+    return ak.Array(events)
+
+#MC events are weighted by totalWeight where the booking says so, and events outside the bins are left out
+def test_fill_histograms_weights_mc_events():
+    histograms = reading.book_histograms()
+    reading.fill_histograms(histograms, selected_events([0.5, 2.0, 3.0, 4.0]))
+    mllll = histograms["mllll"]
+    assert mllll["sumw"].sum() == 5.5 and mllll["sumw2"].sum() == 13.25
+    assert mllll["sumw"][np.searchsorted(mllll["edges"][0], 125.0, side="right") - 1] == 5.0
+    #m34 counts each event once, the one at 160 is past the last bin
+    assert histograms["m34"]["sumw"].sum() == histograms["m34"]["sumw2"].sum() == 3
+    assert histograms["m12_m34"]["sumw"].shape == (30, 30) and histograms["m12_m34"]["sumw"].sum() == 3
+
+#data events have no weights and count once each, batches add up
+def test_fill_histograms_counts_data_events():
+    histograms = reading.book_histograms()
+    reading.fill_histograms(histograms, selected_events())
+    reading.fill_histograms(histograms, selected_events())
+    assert histograms["mllll"]["sumw"].sum() == histograms["mllll"]["sumw2"].sum() == 6
+
+#plotting adds up the histograms of every committed range by the category of its sample
+def test_merge_histograms_by_category(worker, tmp_path):
+    for sample, start, weights in [("data_A", 0, None), ("data_B", 0, None), ("llll", 0, [1.0, 1.0, 1.0, 1.0])]:
+        histograms = reading.book_histograms()
+        reading.fill_histograms(histograms, selected_events(weights))
+        reading.commit_output(None, histograms, "run", sample, start, 4)
+    merged = plotting.merge_histograms("run", str(tmp_path))
+    assert sorted(merged) == ["Background $ZZ^*$", "data"]
+    sumw, sumw2, edges = plotting.category_histogram(merged, "data", "mllll")
+    assert sumw.sum() == sumw2.sum() == 6 and len(edges[0]) == 35
+    sumw, _, _ = plotting.category_histogram(merged, r"Signal ($m_H$ = 125 GeV)", "mllll")
+    assert sumw.sum() == 0
+
+#each batch becomes one row group of the events file, and a failed read leaves no partial file behind
+def test_event_writer_writes_one_row_group_per_batch(tmp_path):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "events.parquet")
+    with reading.event_writer(path) as write:
+        write(selected_events([1.0, 2.0, 3.0, 4.0]))
+        write(selected_events([5.0, 6.0, 7.0, 8.0])[:2])
+    assert pyarrow_parquet.ParquetFile(path).num_row_groups == 2
+    events = ak.from_parquet(path)
+    assert len(events) == 6 and ak.to_list(events.totalWeight) == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+
+    with pytest.raises(OSError):
+        with reading.event_writer(path) as write:
+            write(selected_events())
+            raise OSError("connection reset")
+    assert not (tmp_path / "events.parquet").exists()
@@ -0,0 +1,98 @@
+#tests of how tasks move between the queues when workers die or tasks fail, run against fakeredis:
+#    python -m pytest tests
+import json
+import time
+
+import pytest
+
+import manager
+import reading
+
+
+def task(sample, start, end, **fields):
+    return {"run_id": "run", "task_id": f"{sample}:{start}-{end}", "sample": sample, "start": start, "end": end,
+            "worker_id": 1, "cost": 1.0, **fields}
+
+#the tasks of a worker whose heartbeat expired go back on the queue, shortened to where other workers
+#stole their ends, and the worker's running ranges and registration are removed
+def test_requeue_takes_back_the_tasks_of_a_dead_worker(r):
+    r.sadd("workers", "worker-a", "worker-b")
+    r.set("heartbeat:worker-b", 1)
+    r.rpush("processing:worker-a", json.dumps(task("data_A", 0, 1000)), json.dumps(task("data_B", 0, 500)))
+    r.rpush("processing:worker-b", json.dumps(task("data_C", 0, 100)))
+    r.hset("range:run:data_A:0", mapping={"end": 600, "worker": "worker-a"})
+    r.sadd("running:run", "range:run:data_A:0")
+
+    assert manager.requeue_stalled_tasks(r, "run") == 2
+    queued = sorted((item["sample"], item["end"], item["reaped"]) for item in map(json.loads, r.lrange("work_queue", 0, -1)))
+    assert queued == [("data_A", 600, 1), ("data_B", 500, 1)]
+    assert not r.exists("processing:worker-a", "range:run:data_A:0", "running:run")
+    assert r.smembers("workers") == {"worker-b"} and r.llen("processing:worker-b") == 1
+
+#in priority mode the requeued tasks go back into the sorted set by their cost, tasks of other runs are dropped
+def test_requeue_keeps_the_priority_and_drops_other_runs(r):
+    r.sadd("workers", "worker-a")
+    r.set("queue_mode", "priority")
+    r.rpush("processing:worker-a", json.dumps(task("data_A", 0, 1000, cost=7.0)),
+            json.dumps(task("data_B", 0, 500, run_id="old")))
+    assert manager.requeue_stalled_tasks(r, "run") == 1
+    [(queued, cost)] = r.zrange("work_pqueue", 0, -1, withscores=True)
+    assert json.loads(queued)["sample"] == "data_A" and cost == 7.0
+    assert r.llen("work_queue") == 0
+
+#a transient failure is retried after a doubling backoff, shortened to where its end was stolen,
+#and quarantined with every traceback once it has used up its attempts
+def test_fail_task_retries_then_quarantines(r, monkeypatch):
+    monkeypatch.setattr(reading, "MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(reading, "stolen_ends", {("data_A", 0): 600})
+    work_item_json = json.dumps(task("data_A", 0, 1000))
+    r.rpush("processing:worker-a", work_item_json)
+    reading.fail_task(r, "processing:worker-a", work_item_json, ConnectionResetError("reset"))
+    [(retry, due)] = r.zrange("retry_queue", 0, -1, withscores=True)
+    retried = json.loads(retry)
+    assert (retried["end"], retried["attempts"], len(retried["errors"])) == (600, 1, 1)
+    assert due > time.time() + reading.RETRY_BACKOFF - 5
+    assert r.llen("processing:worker-a") == 0
+
+    r.zrem("retry_queue", retry)
+    r.rpush("processing:worker-a", retry)
+    reading.fail_task(r, "processing:worker-a", retry, ConnectionResetError("reset"))
+    quarantined = json.loads(r.lindex("quarantine", 0))
+    assert (quarantined["attempts"], len(quarantined["errors"])) == (2, 2)
+    assert [fields["type"] for _, fields in r.xrange("events:run")] == ["task_retry", "task_failed"]
+
+def test_fail_task_quarantines_errors_a_retry_would_not_fix(r):
+    work_item_json = json.dumps(task("data_A", 0, 1000))
+    reading.fail_task(r, "processing:worker-a", work_item_json, FileNotFoundError("data_A.4lep.root"))
+    assert r.zcard("retry_queue") == 0 and json.loads(r.lindex("quarantine", 0))["attempts"] == 1
+
+#a task that ran out of memory is replaced by its halves, parts already committed or stolen are left out,
+#and the piece ids never collide with the ids of stolen tasks
+def test_split_task_halves_what_is_left(r, monkeypatch):
+    monkeypatch.setattr(reading, "MIN_SPLIT_ENTRIES", 100)
+    monkeypatch.setattr(reading, "stolen_ends", {("data_B", 0): 1000})
+    work_item = task("merged", 0, 0, parts=[{"sample": "data_A", "start": 0, "end": 500, "worker_id": 1},
+                                            {"sample": "data_B", "start": 0, "end": 2000, "worker_id": 1},
+                                            {"sample": "data_C", "start": 0, "end": 150, "worker_id": 1}])
+    work_item_json = json.dumps(work_item)
+    r.rpush("processing:worker-a", work_item_json)
+    r.set("commit:run:data_A:0-500", "done")
+    assert reading.split_task(r, "processing:worker-a", work_item_json, "out of memory")
+
+    pieces = [json.loads(piece) for piece in r.lrange("work_queue", 0, -1)]
+    assert [(piece["sample"], piece["start"], piece["end"]) for piece in pieces] == [
+        ("data_B", 0, 500), ("data_B", 500, 1000), ("data_C", 0, 150)]
+    assert all(piece["splits"] == 1 and "/split" in piece["task_id"] for piece in pieces)
+    assert len({(piece["sample"], piece["worker_id"]) for piece in pieces}) == 3
+    assert sum(piece["cost"] for piece in pieces) == pytest.approx(work_item["cost"])
+    assert r.llen("processing:worker-a") == 0
+    [(_, event)] = r.xrange("events:run")
+    assert (event["type"], event["pieces"], json.loads(event["sizes"])) == ("task_split", "3", {"data_B": 500, "data_C": 150})
+
+#a task smaller than two pieces of MIN_SPLIT_ENTRIES stays as it is
+def test_split_task_keeps_small_tasks(r, monkeypatch):
+    monkeypatch.setattr(reading, "MIN_SPLIT_ENTRIES", 1000)
+    work_item_json = json.dumps(task("data_A", 0, 1500))
+    r.rpush("processing:worker-a", work_item_json)
+    assert not reading.split_task(r, "processing:worker-a", work_item_json, "out of memory")
+    assert r.llen("work_queue") == 0 and r.llen("processing:worker-a") == 1
@@ -0,0 +1,95 @@
+#tests of the Redis scripts that move ranges between workers, run against fakeredis with its Lua support:
+#    pip install -r tests/requirements.txt
+#    python -m pytest tests
+import json
+
+import pytest
+
+from conftest import ENTRIES
+import reading
+
+
+#batches of 2500, 5000, 10000 and 20000 entries
+@pytest.fixture
+def doubling_batches(monkeypatch, worker):
+    monkeypatch.setattr(reading, "STEP_BYTES", 1)
+    monkeypatch.setattr(reading, "MIN_STEP_ENTRIES", 2500)
+    monkeypatch.setattr(reading, "STEAL_MIN_ENTRIES", 1000)
+    monkeypatch.setattr(reading, "next_step_size", lambda entries, rss_before, peak, budget: 2 * entries)
+
+def publish_range(r, run_id, sample, start, end):
+    range_key = f"range:{run_id}:{sample}:{start}"
+    r.hset(range_key, mapping={"sample": sample, "task_id": f"{sample}:{start}-{end}", "start": start, "end": end,
+                               "cursor": start, "step": end - start, "worker_id": 1, "worker": reading.WORKER_NAME,
+                               "started": 0})
+    r.sadd(f"running:{run_id}", range_key)
+    return range_key
+
+#a steal right after the owner published its cursor splits the range beyond the owner's next batch,
+#so the two halves together read every entry exactly once
+def test_steal_splits_beyond_the_next_batch(r, tuple_dir, doubling_batches):
+    tuple_file = tuple_dir + "Data/data_A.4lep.root"
+    r.set("current_run", "run")
+    range_key = publish_range(r, "run", "data_A", 0, ENTRIES)
+    stolen = []
+    def on_batch(cursor, step):
+        end = reading.advance_range(r, range_key, "commit:run:data_A:0-", cursor, step)
+        if cursor == 17500:
+            stolen.append(json.loads(reading.steal_work(r, "processing:thief")))
+        return end
+
+    _, owner, _ = reading.read_file(tuple_file, "data_A", 0, ENTRIES, 1, "run", on_batch)
+    task = stolen[0]
+    assert task["start"] == owner["end"] == int(r.hget(range_key, "end"))
+    assert task["end"] == ENTRIES
+    _, thief, _ = reading.read_file(tuple_file, "data_A", task["start"], task["end"], task["worker_id"], "run")
+    assert owner["events_in"] + thief["events_in"] == ENTRIES
+
+#the stolen half is queued on the thief's processing list and the range keeps the first half
+def test_steal_takes_the_largest_range(r):
+    r.set("current_run", "run")
+    small = publish_range(r, "run", "data_A", 0, 10000)
+    large = publish_range(r, "run", "data_B", 0, 30000)
+    r.hset(large, mapping={"cursor": 5000, "step": 5000})
+    task = json.loads(reading.steal_work(r, "processing:thief"))
+    assert (task["sample"], task["start"], task["end"]) == ("data_B", 20000, 30000)
+    assert task["stolen_from"] == "data_B:0-30000"
+    assert r.hget(large, "end") == "20000" and r.hget(small, "end") == "10000"
+    assert json.loads(r.lindex("processing:thief", 0)) == task
+
+def test_steal_leaves_small_and_nosteal_ranges(r, monkeypatch):
+    monkeypatch.setattr(reading, "STEAL_MIN_ENTRIES", 1000)
+    r.set("current_run", "run")
+    publish_range(r, "run", "data_A", 0, 1999)
+    r.hset(publish_range(r, "run", "data_B", 0, 30000), "nosteal", 1)
+    assert reading.steal_work(r, "processing:thief") is None
+
+#the owner stops at the new end after a steal, and where it is once a speculative copy has committed
+def test_advance_returns_the_current_end(r):
+    range_key = publish_range(r, "run", "data_A", 0, 30000)
+    assert reading.advance_range(r, range_key, "commit:run:data_A:0-", 5000, 5000) == 30000
+    r.hset(range_key, "end", 20000)
+    assert reading.advance_range(r, range_key, "commit:run:data_A:0-", 10000, 5000) == 20000
+    r.set("commit:run:data_A:0-20000", "worker-b")
+    assert reading.advance_range(r, range_key, "commit:run:data_A:0-", 15000, 5000) == 15000
+    assert r.hget(range_key, "cursor") == "15000"
+
+#a range the manager requeued from a worker whose heartbeat lapsed is removed, or published again by the
+#worker now reading it, and its old owner stops without failing the task
+def test_advance_stops_a_requeued_range(r):
+    range_key = publish_range(r, "run", "data_A", 0, 30000)
+    r.hset(range_key, "worker", "worker-b")
+    with pytest.raises(reading.RangeTakenAway):
+        reading.advance_range(r, range_key, "commit:run:data_A:0-", 5000, 5000)
+    assert r.hget(range_key, "cursor") == "0"
+    r.delete(range_key)
+    with pytest.raises(reading.RangeTakenAway):
+        reading.advance_range(r, range_key, "commit:run:data_A:0-", 5000, 5000)
+    assert not r.exists(range_key)
+
+def test_process_range_leaves_a_requeued_range(r, doubling_batches, monkeypatch):
+    range_key = "range:run:data_A:0"
+    monkeypatch.setattr(reading, "report_progress", lambda: r.delete(range_key))
+    with pytest.raises(reading.RangeTakenAway):
+        reading.process_range(r, "run", "data_A:0-40000", "data_A", 0, ENTRIES, 1)
+    assert r.llen("ledger:run:done") == 0 and not r.exists("commit:run:data_A:0-40000")